@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+"""
+Benchmark the preprocessing scripts and the MCP server on synthetic OMOP data.
+
+A synthetic OMOP extract with the table layouts of clickhouse-init.xml, covering every table of
+ID_COLUMNS and DATE_COLUMNS, is generated at a configurable number of persons. rewrite_ids.py and
+shift_omop_dates.py then run on it as subprocesses, measuring wall time, throughput and peak RSS,
+and query_omop_database is called through in-memory MCP sessions at increasing concurrency against
+the ClickHouse server configured by the CLICKHOUSE_* environment variables. Results are written as
+JSON, and --compare prints the ratios against a previous run.
+"""
+
+import os
+import argparse
+import asyncio
+import gzip
+import json
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from omop_schema import load_csv_formats, load_table_schemas
+from rewrite_ids import ID_COLUMNS
+from shift_omop_dates import DATE_COLUMNS
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+CHUNK_ROWS = 500_000
+CONCEPTS = 5_000
+
+# Rows per person of the clinical tables, other tables get a fixed number of rows
+ROWS_PER_PERSON = {
+    'person': 1, 'observation_period': 1, 'death': 0.05, 'payer_plan_period': 1,
+    'visit_occurrence': 10, 'visit_detail': 5, 'condition_occurrence': 8, 'drug_exposure': 12,
+    'procedure_occurrence': 5, 'device_exposure': 1, 'measurement': 30, 'observation': 10,
+    'note': 2, 'note_nlp': 4, 'specimen': 0.5, 'cost': 5,
+    'drug_era': 3, 'dose_era': 1, 'condition_era': 3,
+    'cohort': 0.5, 'cohort_attribute': 0.5, 'fact_relationship': 1,
+    'location': 0.1, 'care_site': 0.01, 'provider': 0.05,
+}
+FIXED_ROWS = {
+    'concept': CONCEPTS, 'concept_synonym': CONCEPTS, 'concept_relationship': 2 * CONCEPTS,
+    'concept_ancestor': 3 * CONCEPTS, 'drug_strength': 1000, 'vocabulary': 50, 'domain': 50,
+    'concept_class': 100, 'relationship': 100, 'cohort_definition': 10, 'attribute_definition': 10,
+    'cdm_source': 1, 'metadata': 10,
+}
+
+# Tables whose IDs other tables refer to, generated first
+REFERENCED_TABLES = ['location', 'care_site', 'provider', 'person', 'visit_occurrence', 'visit_detail',
+                     'note', 'payer_plan_period']
+# Foreign keys named after another table's ID column
+REFERENCES = {
+    'subject_id': 'person_id',
+    'preceding_visit_occurrence_id': 'visit_occurrence_id',
+    'preceding_visit_detail_id': 'visit_detail_id',
+    'visit_detail_parent_id': 'visit_detail_id',
+}
+# Share of empty values in optional foreign keys and source values
+EMPTY_FRACTION = 0.1
+
+def primary_key(table):
+    """The ID column a table generates, or None for tables like death keyed by another table's ID"""
+    col = f"{table}_id"
+    return col if any(name == col for name, _ in load_table_schemas().get(table, [])) else None
+
+def table_rows(table, persons):
+    if table in ROWS_PER_PERSON:
+        return max(1, int(persons * ROWS_PER_PERSON[table]))
+    return FIXED_ROWS.get(table, 100)
+
+def sparse_ids(rng, n, start):
+    """Increasing IDs with random gaps, the way source systems hand them out"""
+    return start + np.cumsum(rng.integers(1, 100, n))
+
+def with_empty_values(rng, values):
+    """Blank out EMPTY_FRACTION of the values"""
+    empty = rng.random(len(values)) < EMPTY_FRACTION
+    if isinstance(values, np.ndarray) and values.dtype.kind in 'iu':
+        values = pd.array(values, dtype='Int64')
+        values[empty] = pd.NA
+        return values
+    values = pd.Series(values, dtype=object)
+    values[empty] = None
+    return values
+
+def generate_column(rng, table, col, ch_type, n, ids, start_days, pools, concept_weights):
+    """Values of one column for a chunk of n rows"""
+    base_type = ch_type.split('(')[0]
+    if ids is not None and col == primary_key(table):
+        return ids
+    if table == 'person' and col in ('year_of_birth', 'month_of_birth', 'day_of_birth', 'birth_datetime'):
+        birth = np.datetime64('1930-01-01') + start_days
+        if col == 'year_of_birth':
+            return birth.astype('datetime64[Y]').astype(int) + 1970
+        if col == 'month_of_birth':
+            return birth.astype('datetime64[M]').astype(int) % 12 + 1
+        if col == 'day_of_birth':
+            return (birth - birth.astype('datetime64[M]')).astype(int) + 1
+        return pd.Series(birth.astype('datetime64[s]'))
+    if col.endswith(('concept_id', 'concept_id_1', 'concept_id_2')):
+        return rng.choice(pools['concept_id'], n, p=concept_weights)
+    pool = pools.get(REFERENCES.get(col, col))
+    if pool is not None:
+        if table == 'death' and col == 'person_id':
+            return rng.choice(pool, min(n, len(pool)), replace=False)
+        values = rng.choice(pool, n)
+        return values if col == 'person_id' else with_empty_values(rng, values)
+    if base_type in ('Date', 'Date32', 'DateTime', 'DateTime64'):
+        days = start_days + (rng.integers(0, 30, n) if 'end' in col else 0)
+        dates = np.datetime64('2000-01-01') + days
+        if base_type.startswith('DateTime'):
+            return pd.Series(dates.astype('datetime64[s]') + rng.integers(0, 86400, n).astype('timedelta64[s]'))
+        return np.datetime_as_string(dates, unit='D')
+    if base_type.startswith(('UInt', 'Int')):
+        values = rng.integers(1, 10**6 if col.endswith('_id') else 100, n)
+        return with_empty_values(rng, values) if col.endswith('_id') else values
+    if base_type.startswith('Float'):
+        return rng.normal(50, 20, n).round(2)
+    values = col + '_' + pd.Series(rng.integers(0, 1000, n)).astype(str)
+    if col == 'note_text':
+        values = values + ' ' + 'lorem ipsum dolor sit amet ' * 8
+    return with_empty_values(rng, values) if col.endswith('_source_value') else values
+
+def generate_table(rng, table, persons, data_dir, pools, concept_weights):
+    """Write <table>.csv.gz in the format of clickhouse-init.xml, return its row count"""
+    columns = load_table_schemas()[table]
+    delimiter = '\t' if load_csv_formats().get(table, '').startswith('TabSeparated') else ','
+    key = primary_key(table)
+    total = table_rows(table, persons)
+    if table == 'concept':
+        total = len(pools['concept_id'])
+    next_id = int(rng.integers(10**6, 10**8))
+    pool = [] if table in REFERENCED_TABLES and key else None
+    rows = 0
+    with gzip.open(os.path.join(data_dir, f"{table}.csv.gz"), 'wt', compresslevel=1, newline='') as f:
+        for offset in range(0, total, CHUNK_ROWS):
+            n = min(CHUNK_ROWS, total - offset)
+            ids = None
+            if table == 'concept':
+                ids = pools['concept_id'][offset:offset + n]
+            elif key:
+                ids = sparse_ids(rng, n, next_id)
+                next_id = int(ids[-1])
+            start_days = rng.integers(0, 80 * 365 if table == 'person' else 24 * 365 - 30, n)
+            data = {
+                col: generate_column(rng, table, col, ch_type, n, ids, start_days, pools, concept_weights)
+                for col, ch_type in columns
+            }
+            # Tables keyed by another table's ID, like death, may get fewer rows than asked for
+            n = min(len(values) for values in data.values())
+            df = pd.DataFrame({col: pd.Series(values)[:n].reset_index(drop=True) for col, values in data.items()})
+            df.to_csv(f, index=False, header=offset == 0, sep=delimiter)
+            if pool is not None:
+                pool.append(ids)
+            rows += n
+    if pool is not None:
+        pools[key] = np.concatenate(pool)
+    return rows
+
+def generate_omop(data_dir, persons, seed=42):
+    """Generate a synthetic OMOP extract, return {table: rows}"""
+    rng = np.random.default_rng(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    schemas = load_table_schemas()
+    tables = [t for t in sorted(set(ID_COLUMNS) | set(DATE_COLUMNS)) if t in schemas]
+    tables.sort(key=lambda t: REFERENCED_TABLES.index(t) if t in REFERENCED_TABLES else len(REFERENCED_TABLES))
+    # A few concepts account for most events, as in real data
+    pools = {'concept_id': np.sort(rng.choice(np.arange(1, 50_000_000), CONCEPTS, replace=False))}
+    weights = 1 / np.arange(1, CONCEPTS + 1)
+    concept_weights = rng.permutation(weights / weights.sum())
+    return {table: generate_table(rng, table, persons, data_dir, pools, concept_weights) for table in tables}
+
+def process_tree_memory(pid, peaks=None):
+    """Current RSS in bytes of a process and its descendants, recording the peak RSS of each process.
+
+    VmHWM starts over at exec, so unlike ru_maxrss it does not include the benchmark process the
+    script was forked from. Returns None where /proc is unavailable.
+    """
+    peaks = {} if peaks is None else peaks
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+    kilobytes = lambda field: int(status.get(field, '0 kB').split()[0]) * 1024
+    peaks[pid] = max(peaks.get(pid, 0), kilobytes('VmHWM'))
+    return kilobytes('VmRSS') + sum(process_tree_memory(child, peaks) or 0 for child in children)
+
+def run_script(script, args, work_dir, log_path, sample_interval=0.05):
+    """Run a script in work_dir, return (seconds, exit code, largest process peak RSS, peak tree RSS)"""
+    peaks = {}
+    peak_tree = None
+    with open(log_path, 'w') as log:
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, os.path.join(ROOT, script), *args],
+                                cwd=work_dir, stdout=log, stderr=subprocess.STDOUT)
+        while proc.poll() is None:
+            rss = process_tree_memory(proc.pid, peaks)
+            if rss is not None:
+                peak_tree = max(peak_tree or 0, rss)
+            time.sleep(sample_interval)
+        seconds = time.perf_counter() - start
+    return seconds, proc.returncode, max(peaks.values(), default=None), peak_tree
+
+def benchmark_scripts(data_dir, work_dir, tables, jobs_list, output_formats, repeat):
+    """Time rewrite_ids.py and shift_omop_dates.py on the generated data"""
+    # shift_omop_dates.py reads the backup directory the original workflow creates
+    os.symlink(os.path.abspath(data_dir), os.path.join(work_dir, 'omop_data_csv_bak'))
+    scripts = [
+        ('rewrite_ids.py', 'omop_data_csv_rewritten', [t for t in tables if t in ID_COLUMNS]),
+        ('shift_omop_dates.py', 'omop_data_csv_shifted', list(tables)),
+    ]
+    input_bytes = {t: os.path.getsize(os.path.join(data_dir, f"{t}.csv.gz")) for t in tables}
+    results = []
+    for script, output_dir, script_tables in scripts:
+        rows = sum(tables[t] for t in script_tables)
+        nbytes = sum(input_bytes[t] for t in script_tables)
+        for output_format in output_formats:
+            for jobs in jobs_list:
+                runs = []
+                for run in range(repeat):
+                    shutil.rmtree(os.path.join(work_dir, output_dir), ignore_errors=True)
+                    log_path = os.path.join(work_dir, f"{script[:-3]}.{output_format}.{jobs}.{run}.log")
+                    seconds, code, peak, peak_tree = run_script(
+                        script, ['--jobs', str(jobs), '--output-format', output_format], work_dir, log_path)
+                    runs.append({'seconds': round(seconds, 3), 'exit_code': code, 'peak_rss_bytes': peak,
+                                 'peak_tree_rss_bytes': peak_tree, 'log': log_path})
+                    print(f"  {script} --jobs {jobs} --output-format {output_format}: {seconds:.2f}s, "
+                          f"peak RSS {(peak or 0) / 2**20:.0f} MiB" + (f" (exit code {code})" if code else ""))
+                seconds = statistics.median(run['seconds'] for run in runs)
+                peaks = [run['peak_rss_bytes'] for run in runs if run['peak_rss_bytes'] is not None]
+                tree_peaks = [run['peak_tree_rss_bytes'] for run in runs if run['peak_tree_rss_bytes'] is not None]
+                results.append({
+                    'script': script,
+                    'jobs': jobs,
+                    'output_format': output_format,
+                    'input_rows': rows,
+                    'input_bytes': nbytes,
+                    'seconds': seconds,
+                    'rows_per_second': round(rows / seconds) if seconds else None,
+                    'input_mb_per_second': round(nbytes / 2**20 / seconds, 2) if seconds else None,
+                    'peak_rss_bytes': max(peaks) if peaks else None,
+                    'peak_tree_rss_bytes': max(tree_peaks) if tree_peaks else None,
+                    'failed_runs': sum(run['exit_code'] != 0 for run in runs),
+                    'runs': runs,
+                })
+    return results
+
+# Typical agent queries, formatted with the parameters from pick_parameters
+QUERIES = {
+    'patient_visits': """
+        SELECT visit_start_date, visit_end_date, visit_concept_id
+        FROM visit_occurrence WHERE person_id = {person_id} ORDER BY visit_start_date""",
+    'patient_drugs': "SELECT * FROM drug_exposure WHERE person_id = {person_id}",
+    'top_conditions': """
+        SELECT condition_concept_id, count() AS records, uniqExact(person_id) AS patients
+        FROM condition_occurrence GROUP BY condition_concept_id ORDER BY records DESC LIMIT 20""",
+    'measurement_summary': """
+        SELECT measurement_concept_id, count() AS records, avg(value_as_number) AS mean
+        FROM measurement WHERE measurement_concept_id = {concept_id} GROUP BY measurement_concept_id""",
+    'condition_then_drug': """
+        SELECT count(DISTINCT person_id) FROM drug_exposure
+        WHERE person_id IN (SELECT person_id FROM condition_occurrence WHERE condition_concept_id = {concept_id})""",
+}
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    pick = lambda p: values[max(0, int(np.ceil(p / 100 * len(values))) - 1)]
+    return {'p50': pick(50), 'p90': pick(90), 'p95': pick(95), 'p99': pick(99), 'max': values[-1]}
+
+def load_generated_data(data_dir, database):
+    """Load the generated files into a ClickHouse database with load_omop.py"""
+    from load_omop import backfill_rollups, create_schema, find_source_files, get_client, insert_settings, load_table
+
+    client = get_client()
+    try:
+        create_schema(client, database)
+        settings = insert_settings(1_000_000, 4)
+        for table, (path, fmt) in find_source_files(data_dir, load_csv_formats()).items():
+            status, rows, _ = load_table(table, path, fmt, database, settings)
+            print(f"  {table}: {status}, {rows} rows")
+        backfill_rollups(client, database)
+    finally:
+        client.close()
+
+def pick_parameters(database, count, seed, backend='clickhouse'):
+    """Random persons and frequent concepts for the query templates"""
+    queries = [
+        f"SELECT person_id FROM person ORDER BY cityHash64(person_id, {int(seed)}) LIMIT {int(count)}",
+        "SELECT condition_concept_id FROM condition_occurrence GROUP BY 1 ORDER BY count() DESC LIMIT 50",
+    ]
+    if backend == 'chdb':
+        from local_engine import engine_from_env
+
+        # Opening the engine also loads the generated files, before the timed levels
+        client = engine_from_env(database)
+        client.open()
+    else:
+        from load_omop import get_client
+
+        client = get_client(database)
+    try:
+        persons, concepts = ([row[0] for row in client.query(query).result_rows] for query in queries)
+    finally:
+        client.close()
+    return persons or [0], concepts or [0]
+
+async def run_level(server, concurrency, requests, persons, concepts, rng):
+    """Run requests through one MCP session per concurrent agent, return the per-call samples"""
+    from contextlib import AsyncExitStack
+    from mcp.shared.memory import create_connected_server_and_client_session
+
+    names = list(QUERIES)
+    calls = []
+    for _ in range(requests):
+        name = names[rng.integers(len(names))]
+        calls.append((name, QUERIES[name].format(person_id=rng.choice(persons), concept_id=rng.choice(concepts))))
+    samples = []
+
+    async def agent(session):
+        while calls:
+            name, query = calls.pop()
+            start = time.perf_counter()
+            result = await session.call_tool('query_omop_database', {'query': query})
+            samples.append((name, time.perf_counter() - start, result.isError))
+
+    async with AsyncExitStack() as stack:
+        sessions = [await stack.enter_async_context(create_connected_server_and_client_session(server.mcp._mcp_server))
+                    for _ in range(concurrency)]
+        # Warm up the pool, then time the level, with server metrics of this level only
+        await asyncio.gather(*(session.call_tool('query_omop_database', {'query': 'SELECT 1'}) for session in sessions))
+        server._query_metrics.reset()
+        start = time.perf_counter()
+        await asyncio.gather(*(agent(session) for session in sessions))
+        seconds = time.perf_counter() - start
+        server_stats = server._query_metrics.stats()
+    return samples, seconds, server_stats
+
+def benchmark_queries(database, levels, requests, seed, with_cache, backend='clickhouse'):
+    """Latency and throughput of query_omop_database at each concurrency level"""
+    os.environ['CLICKHOUSE_DB'] = database
+    os.environ['OMOP_BACKEND'] = backend
+    os.environ.setdefault('OMOP_CONCEPT_INDEX_PRELOAD', '0')
+    if not with_cache:
+        os.environ['OMOP_CACHE_MAX_ENTRIES'] = '0'
+    import logging
+    import server
+
+    # FastMCP logs every request at INFO level
+    logging.getLogger('mcp').setLevel(logging.WARNING)
+    rng = np.random.default_rng(seed)
+    persons, concepts = pick_parameters(database, 1000, seed, backend)
+    results = []
+    for concurrency in levels:
+        samples, seconds, server_stats = asyncio.run(run_level(server, concurrency, requests, persons, concepts, rng))
+        # Failed calls often return at once, so only successful ones count in throughput and latency
+        succeeded = [(name, s) for name, s, error in samples if not error]
+        errors = len(samples) - len(succeeded)
+        level = {
+            'concurrency': concurrency,
+            'requests': len(samples),
+            'errors': errors,
+            'failed': errors > 0,
+            'seconds': round(seconds, 3),
+            'requests_per_second': round(len(succeeded) / seconds, 2) if seconds else None,
+            'latency_seconds': percentiles([s for _, s in succeeded]),
+            'latency_seconds_by_query': {
+                name: percentiles([s for n, s in succeeded if n == name]) for name in QUERIES
+            },
+            'server_latency_seconds': server_stats['latency_seconds'],
+            'server_errors': server_stats['errors'],
+        }
+        results.append(level)
+        p = level['latency_seconds']
+        print(f"  concurrency {concurrency}: {level['requests_per_second']} req/s, "
+              f"p50 {p.get('p50', 0) * 1000:.1f} ms, p95 {p.get('p95', 0) * 1000:.1f} ms, {errors} errors"
+              + (" (FAILED)" if errors else ""))
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def ratio(new, old):
+    return f"{new / old:.2f}x" if new and old else "n/a"
+
+def compare(results, baseline_path):
+    """Print the ratio of each measurement to the same one in a previous result file"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    old_scripts = {(r['script'], r['jobs'], r['output_format']): r for r in baseline.get('scripts') or []}
+    print(f"\nCompared with {baseline_path} (new / old):")
+    for r in results.get('scripts') or []:
+        old = old_scripts.get((r['script'], r['jobs'], r['output_format']))
+        if old:
+            print(f"  {r['script']} --jobs {r['jobs']} {r['output_format']}: time {ratio(r['seconds'], old['seconds'])}, "
+                  f"peak RSS {ratio(r['peak_rss_bytes'], old['peak_rss_bytes'])}")
+    old_levels = {r['concurrency']: r for r in (baseline.get('queries') or {}).get('levels') or []}
+    for r in (results.get('queries') or {}).get('levels') or []:
+        old = old_levels.get(r['concurrency'])
+        if old:
+            failed = " (failed level)" if r.get('failed') or old.get('failed') else ""
+            print(f"  queries at concurrency {r['concurrency']}: throughput "
+                  f"{ratio(r['requests_per_second'], old['requests_per_second'])}, p95 latency "
+                  f"{ratio(r['latency_seconds'].get('p95'), old['latency_seconds'].get('p95'))}{failed}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the preprocessing scripts and the MCP server on synthetic OMOP data.")
+    parser.add_argument('--persons', type=int, default=10_000, help="Number of synthetic persons (default: 10000)")
+    parser.add_argument('--seed', type=int, default=42, help="Random seed of the generated data (default: 42)")
+    parser.add_argument('--work-dir', default=None,
+                        help="Directory for the generated data and script outputs (default: a temporary directory)")
+    parser.add_argument('--keep', action='store_true', help="Keep the work directory")
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1, 4],
+                        help="--jobs values to run the scripts with (default: 1 4)")
+    parser.add_argument('--output-formats', nargs='+', choices=('csv', 'parquet'), default=['csv'],
+                        help="Output formats to run the scripts with (default: csv)")
+    parser.add_argument('--repeat', type=int, default=1, help="Runs per script configuration (default: 1)")
+    parser.add_argument('--skip-scripts', action='store_true', help="Do not benchmark the preprocessing scripts")
+    parser.add_argument('--skip-queries', action='store_true', help="Do not benchmark query_omop_database")
+    parser.add_argument('--database', default='omop_bench',
+                        help="ClickHouse database queried by the benchmark (default: omop_bench)")
+    parser.add_argument('--load', action='store_true', help="Load the generated data into --database first")
+    parser.add_argument('--backend', choices=('clickhouse', 'chdb'), default='clickhouse',
+                        help="Query the ClickHouse server, or the embedded chDB engine over the generated files "
+                             "(default: clickhouse)")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16],
+                        help="Concurrent MCP sessions to measure (default: 1 2 4 8 16)")
+    parser.add_argument('--requests', type=int, default=200, help="Queries per concurrency level (default: 200)")
+    parser.add_argument('--with-cache', action='store_true', help="Keep the query result cache enabled")
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help="JSON result file (default: benchmark_results.json)")
+    parser.add_argument('--compare', default=None, help="Previous JSON result file to compare with")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='omop_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+    data_dir = os.path.join(work_dir, 'omop_data_csv')
+    results = {
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+    }
+    try:
+        print(f"Generating {args.persons} persons in {data_dir}...")
+        start = time.perf_counter()
+        tables = generate_omop(data_dir, args.persons, args.seed)
+        results['data'] = {
+            'tables': tables,
+            'rows': sum(tables.values()),
+            'bytes': sum(os.path.getsize(os.path.join(data_dir, f"{t}.csv.gz")) for t in tables),
+            'seconds': round(time.perf_counter() - start, 3),
+        }
+        print(f"Generated {results['data']['rows']} rows in {results['data']['seconds']:.2f}s")
+
+        if not args.skip_scripts:
+            print("Benchmarking the preprocessing scripts...")
+            results['scripts'] = benchmark_scripts(data_dir, work_dir, tables, args.jobs, args.output_formats, args.repeat)
+        if not args.skip_queries:
+            print(f"Benchmarking query_omop_database on {args.database} ({args.backend})...")
+            try:
+                if args.backend == 'chdb':
+                    # The engine loads the generated files into its own database in the work directory
+                    os.environ['OMOP_LOCAL_DATA_DIR'] = data_dir
+                    os.environ['OMOP_LOCAL_PATH'] = os.path.join(work_dir, 'chdb')
+                elif args.load:
+                    load_generated_data(data_dir, args.database)
+                results['queries'] = {
+                    'database': args.database,
+                    'backend': args.backend,
+                    'levels': benchmark_queries(args.database, args.concurrency, args.requests, args.seed,
+                                                args.with_cache, args.backend),
+                }
+            except Exception as e:
+                print(f"  Query benchmark failed: {e}")
+                results['queries'] = {'database': args.database, 'backend': args.backend, 'error': str(e)}
+    finally:
+        if not args.keep and not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, default=str)
+    print(f"Results written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Compare typical cohort and patient-timeline queries between the default schema and the
+patient schema profile (see omop_schema.apply_profile).
+
+The event tables of the source database are copied into a second database created with the
+patient profile, then every query runs against both, reporting the median latency, the rows
+read and the speedup.
+"""
+
+import os
+import argparse
+import json
+import statistics
+import time
+from datetime import timedelta
+
+from load_omop import create_schema, get_client
+from omop_schema import EVENT_TABLES
+
+# Typical agent queries, formatted with the database and the parameters from pick_parameters
+QUERIES = {
+    'patient_conditions': """
+        SELECT condition_start_date, condition_concept_id
+        FROM {db}.condition_occurrence
+        WHERE person_id = {person_id}
+        ORDER BY condition_start_date""",
+    'patient_measurements_in_range': """
+        SELECT measurement_date, measurement_concept_id, value_as_number
+        FROM {db}.measurement
+        WHERE person_id = {person_id} AND measurement_date BETWEEN '{since}' AND '{until}'""",
+    'condition_cohort_size': """
+        SELECT uniqExact(person_id)
+        FROM {db}.condition_occurrence
+        WHERE condition_concept_id = {condition_concept_id} AND condition_start_date >= '{since}'""",
+    'drug_cohort_size': """
+        SELECT uniqExact(person_id)
+        FROM {db}.drug_exposure
+        WHERE drug_concept_id = {drug_concept_id} AND drug_exposure_start_date >= '{since}'""",
+    'condition_then_drug': """
+        SELECT count(DISTINCT person_id)
+        FROM {db}.drug_exposure
+        WHERE drug_concept_id = {drug_concept_id}
+          AND person_id IN (
+              SELECT person_id FROM {db}.condition_occurrence
+              WHERE condition_concept_id = {condition_concept_id})""",
+}
+
+def pick_parameters(client, db):
+    """Pick a busy patient, common concepts and the last ten years of data"""
+    if not client.command(f"SELECT count() FROM {db}.condition_occurrence"):
+        raise SystemExit(f"{db}.condition_occurrence is empty, load the OMOP data into {db} first")
+    person_id = client.command(f"SELECT person_id FROM {db}.condition_occurrence GROUP BY person_id ORDER BY count() DESC LIMIT 1")
+    condition = client.command(f"SELECT condition_concept_id FROM {db}.condition_occurrence GROUP BY 1 ORDER BY count() DESC LIMIT 1 OFFSET 10")
+    drug = client.command(f"SELECT drug_concept_id FROM {db}.drug_exposure GROUP BY 1 ORDER BY count() DESC LIMIT 1 OFFSET 10")
+    until = client.query(f"SELECT max(condition_start_date) FROM {db}.condition_occurrence").first_row[0]
+    if until is None:
+        raise SystemExit(f"{db}.condition_occurrence has no condition_start_date to pick a time window from")
+    return {
+        'person_id': person_id,
+        'condition_concept_id': condition or 0,
+        'drug_concept_id': drug or 0,
+        'since': (until - timedelta(days=3652)).isoformat(),
+        'until': until.isoformat(),
+    }
+
+def copy_event_tables(client, source, target):
+    """Fill the event tables of the target database from the source, if they are empty"""
+    for table in EVENT_TABLES:
+        if client.command(f"SELECT count() FROM {target}.{table}") == 0:
+            start = time.perf_counter()
+            client.command(f"INSERT INTO {target}.{table} SELECT * FROM {source}.{table}",
+                           settings={'max_partitions_per_insert_block': 0})
+            print(f"  Copied {table} in {time.perf_counter() - start:.2f}s")
+
+def run_query(client, query, runs):
+    """Median seconds and rows read over several runs, after one warm-up run"""
+    settings = {'use_query_cache': 0}
+    client.query(query, settings=settings)
+    seconds = []
+    read_rows = 0
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = client.query(query, settings=settings)
+        seconds.append(time.perf_counter() - start)
+        read_rows = int(result.summary.get('read_rows', 0))
+    return statistics.median(seconds), read_rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the patient schema profile against the default one.")
+    parser.add_argument('--source', default=os.getenv("CLICKHOUSE_DB", "omop"),
+                        help="Database with the default schema (default: $CLICKHOUSE_DB or omop)")
+    parser.add_argument('--target', default='omop_patient',
+                        help="Database created with the patient profile (default: omop_patient)")
+    parser.add_argument('--partition-by-year', action='store_true',
+                        help="Partition the event tables of the target database by year")
+    parser.add_argument('--runs', type=int, default=5, help="Timed runs per query (default: 5)")
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON")
+    args = parser.parse_args()
+
+    client = get_client()
+    try:
+        create_schema(client, args.target, 'patient', args.partition_by_year)
+        copy_event_tables(client, args.source, args.target)
+        params = pick_parameters(client, args.source)
+
+        results = []
+        for name, template in QUERIES.items():
+            default_s, default_rows = run_query(client, template.format(db=args.source, **params), args.runs)
+            patient_s, patient_rows = run_query(client, template.format(db=args.target, **params), args.runs)
+            results.append({
+                'query': name,
+                'default_ms': round(default_s * 1000, 2),
+                'patient_ms': round(patient_s * 1000, 2),
+                'default_read_rows': default_rows,
+                'patient_read_rows': patient_rows,
+                'speedup': round(default_s / patient_s, 2) if patient_s else None,
+            })
+    finally:
+        client.close()
+
+    if args.json:
+        print(json.dumps({'parameters': params, 'results': results}, indent=2, default=str))
+        return
+    print(f"Parameters: {params}")
+    print(f"{'query':32} {'default ms':>11} {'patient ms':>11} {'default rows':>13} {'patient rows':>13} {'speedup':>8}")
+    for r in results:
+        print(f"{r['query']:32} {r['default_ms']:>11} {r['patient_ms']:>11} "
+              f"{r['default_read_rows']:>13} {r['patient_read_rows']:>13} {r['speedup']:>7}x")
+
+if __name__ == "__main__":
+    main()
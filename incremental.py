@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Change detection for the incremental mode of rewrite_ids.py and shift_omop_dates.py.
+
+A manifest in the state directory records, for every input file, its size, modification time and
+the BLAKE2b digest and length of its decompressed content. On the next run each file is compared
+against it: files with the same content are skipped, files that only had rows appended (a new
+extract batch added to the end) are processed from where the previous content ended, and
+anything else is processed in full.
+"""
+
+import os
+import csv
+import gzip
+import hashlib
+import json
+
+import pandas as pd
+
+MANIFEST_FILE = 'manifest.json'
+READ_SIZE = 4 * 1024 * 1024
+
+def load_manifest(state_dir):
+    """Return {file name: entry} recorded by the previous run, empty if there was none"""
+    path = os.path.join(state_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(state_dir, manifest):
+    """Write the manifest atomically, so an interrupted run keeps the previous one"""
+    os.makedirs(state_dir, exist_ok=True)
+    path = os.path.join(state_dir, MANIFEST_FILE)
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+def content_digest(path, boundary=None):
+    """BLAKE2b digest and length of the decompressed content of a gzipped file.
+
+    With a boundary, also returns the digest of the first `boundary` bytes (None if the content is shorter).
+    """
+    digest = hashlib.blake2b()
+    nbytes = 0
+    boundary_digest = None
+    with gzip.open(path, 'rb') as f:
+        while chunk := f.read(READ_SIZE):
+            if boundary is not None and nbytes <= boundary < nbytes + len(chunk):
+                digest.update(chunk[:boundary - nbytes])
+                boundary_digest = digest.hexdigest()
+                digest.update(chunk[boundary - nbytes:])
+            else:
+                digest.update(chunk)
+            nbytes += len(chunk)
+    if boundary is not None and boundary == nbytes:
+        boundary_digest = digest.hexdigest()
+    return digest.hexdigest(), nbytes, boundary_digest
+
+def file_change(path, previous):
+    """Compare a file with its manifest entry.
+
+    Returns (status, entry, offset): status is 'new', 'unchanged', 'appended' or 'changed', entry is
+    the manifest entry for the file as it is now, and offset is where appended rows start in the
+    decompressed content.
+    """
+    stat = os.stat(path)
+    if previous and previous.get('size') == stat.st_size and previous.get('mtime_ns') == stat.st_mtime_ns:
+        return 'unchanged', dict(previous), None
+    boundary = previous.get('content_bytes') if previous else None
+    digest, nbytes, boundary_digest = content_digest(path, boundary)
+    entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'content_bytes': nbytes, 'digest': digest}
+    if not previous:
+        return 'new', entry, None
+    if digest == previous['digest']:
+        return 'unchanged', {**previous, **entry}, None
+    if boundary_digest == previous['digest'] and boundary > 0:
+        return 'appended', entry, boundary
+    return 'changed', entry, None
+
+def iter_appended_rows(path, offset, sep=None, chunksize=None):
+    """Yield the rows of a gzipped CSV file starting at a byte offset of its decompressed content as
+    dataframes named after its header, in chunks of `chunksize` rows or as a single dataframe.
+    The delimiter is guessed from the header unless given."""
+    with gzip.open(path, 'rb') as f:
+        header = f.readline().decode()
+        if sep is None:
+            sep = '\t' if '\t' in header and ',' not in header else ','
+        names = next(csv.reader([header], delimiter=sep))
+        f.seek(offset)
+        if chunksize:
+            yield from pd.read_csv(f, sep=sep, header=None, names=names, chunksize=chunksize)
+        else:
+            yield pd.read_csv(f, sep=sep, header=None, names=names, low_memory=False)
+
+def output_matches(entry, output_path, output_format):
+    """Whether the output recorded for an input file is still there as the previous run left it"""
+    if not entry or entry.get('output_format') != output_format:
+        return False
+    if entry.get('output_size') is None:
+        return not os.path.exists(output_path)
+    return os.path.exists(output_path) and os.path.getsize(output_path) == entry['output_size']
+
+def plan_file(path, previous, output_path, output_format):
+    """Decide how to process an input file: returns (action, entry, offset) where action is 'skip'
+    when neither the file nor its output changed, 'append' when only the rows from `offset` on need
+    to be appended to a gzipped CSV output, and 'full' otherwise"""
+    status, entry, offset = file_change(path, previous)
+    if not output_matches(previous, output_path, output_format):
+        return 'full', entry, None
+    if status == 'unchanged':
+        return 'skip', entry, None
+    if status == 'appended' and output_format == 'csv' and previous.get('output_size') is not None:
+        return 'append', entry, offset
+    return 'full', entry, None
+
+def record_output(entry, output_path, output_format):
+    """Manifest entry of an input file with the output just written for it, if any"""
+    size = os.path.getsize(output_path) if os.path.exists(output_path) else None
+    return {**entry, 'output_format': output_format, 'output_size': size}
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Bulk load OMOP files into ClickHouse, several tables at a time.
+
+Files are streamed to the server as they are on disk: Parquet as is, gzipped CSV decompressed
+and parsed by ClickHouse itself, so Python never touches the rows. Each load is recorded in a
+manifest table, and tables whose row count and source checksum still match are skipped, which
+makes reruns near-instant.
+"""
+
+import os
+import argparse
+import csv
+import gzip
+import hashlib
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import clickhouse_connect
+from omop_schema import SCHEMA_PROFILES, load_create_queries, load_csv_formats, load_rollups
+
+MANIFEST_TABLE = 'load_manifest'
+READ_SIZE = 4 * 1024 * 1024
+
+def get_client(database=None):
+    """Connect with the same environment variables as the MCP server"""
+    return clickhouse_connect.get_client(
+        host=os.getenv("CLICKHOUSE_HOST", "localhost"),
+        port=int(os.getenv("CLICKHOUSE_PORT", 8123)),
+        username=os.getenv("CLICKHOUSE_USER", "default"),
+        password=os.getenv("CLICKHOUSE_PASSWORD", "default"),
+        database=database,
+        send_receive_timeout=int(os.getenv("CLICKHOUSE_LOAD_TIMEOUT", 3600)),
+    )
+
+def in_database(query, database):
+    """Point a query from clickhouse-init.xml at another database"""
+    return re.sub(r"\bomop\b", database, query)
+
+def create_schema(client, database, profile='default', partition_by_year=False):
+    """Create the database, the OMOP tables and the load manifest if they do not exist"""
+    for query in load_create_queries(profile=profile, partition_by_year=partition_by_year):
+        client.command(in_database(query, database))
+    client.command(f"""
+        CREATE TABLE IF NOT EXISTS {database}.{MANIFEST_TABLE} (
+            table_name String,
+            file_name String,
+            file_size UInt64,
+            checksum String,
+            row_count UInt64,
+            loaded_at DateTime DEFAULT now()
+        ) ENGINE = ReplacingMergeTree(loaded_at)
+        ORDER BY (table_name)
+    """)
+
+def find_source_files(data_dir, formats):
+    """Return {table: (path, format)}, preferring <table>.parquet over <table>.csv.gz"""
+    sources = {}
+    for table, csv_format in formats.items():
+        parquet_path = os.path.join(data_dir, f"{table}.parquet")
+        csv_path = os.path.join(data_dir, f"{table}.csv.gz")
+        if os.path.exists(parquet_path):
+            sources[table] = (parquet_path, 'Parquet')
+        elif os.path.exists(csv_path):
+            sources[table] = (csv_path, csv_format)
+    return sources
+
+def read_chunks(path):
+    """Yield the raw bytes of a file"""
+    with open(path, 'rb') as f:
+        while chunk := f.read(READ_SIZE):
+            yield chunk
+
+def file_checksum(path):
+    """BLAKE2b digest of a file"""
+    digest = hashlib.blake2b()
+    for chunk in read_chunks(path):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def count_source_rows(path, fmt):
+    """Number of data rows in a source file"""
+    if fmt == 'Parquet':
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).metadata.num_rows
+    with gzip.open(path, 'rt', newline='') as f:
+        if fmt.startswith('TabSeparated'):
+            reader = csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
+        else:
+            reader = csv.reader(f)
+        return max(0, sum(1 for _ in reader) - 1)
+
+def insert_settings(block_size, insert_threads, partition_by_year=False):
+    """Settings for one large synchronous bulk insert"""
+    settings = {
+        # Buffering in the server only adds a copy for a single large insert
+        'async_insert': 0,
+        'max_insert_block_size': block_size,
+        'min_insert_block_size_rows': block_size,
+        'min_insert_block_size_bytes': 256 * 1024 * 1024,
+        'input_format_parallel_parsing': 1,
+        'max_insert_threads': insert_threads,
+    }
+    if partition_by_year:
+        # Data spanning a century touches more partitions per insert than the default limit of 100
+        settings['max_partitions_per_insert_block'] = 0
+    return settings
+
+def load_table(table, path, fmt, database, settings, reload=False):
+    """Load one table unless it already matches its source file, return (status, rows, seconds)"""
+    client = get_client(database)
+    try:
+        checksum = file_checksum(path)
+        rows = client.command(f"SELECT count() FROM {database}.{table}")
+        recorded = client.query(
+            f"SELECT checksum, row_count FROM {database}.{MANIFEST_TABLE} FINAL WHERE table_name = %(table)s",
+            parameters={'table': table},
+        ).result_rows
+
+        if not reload and rows > 0:
+            if recorded and recorded[0] == (checksum, rows):
+                return 'skipped (checksum and row count match)', rows, 0.0
+            if not recorded and count_source_rows(path, fmt) == rows:
+                # Loaded by something else, e.g. the startup scripts; adopt it
+                record_load(client, database, table, path, checksum, rows)
+                return 'verified (row count matches)', rows, 0.0
+
+        if rows > 0:
+            client.command(f"TRUNCATE TABLE {database}.{table}")
+        # The materialized views add the new rows to the rollups, which must not keep the old ones
+        for rollup, _ in load_rollups().get(table, []):
+            client.command(f"TRUNCATE TABLE {database}.{rollup}")
+        start = time.perf_counter()
+        client.raw_insert(
+            f"{database}.{table}",
+            insert_block=read_chunks(path),
+            fmt=fmt,
+            compression=None if fmt == 'Parquet' else 'gzip',
+            settings=settings,
+        )
+        seconds = time.perf_counter() - start
+        rows = client.command(f"SELECT count() FROM {database}.{table}")
+        record_load(client, database, table, path, checksum, rows)
+        return 'loaded', rows, seconds
+    finally:
+        client.close()
+
+def backfill_rollups(client, database):
+    """Fill empty rollups of non-empty tables, e.g. tables loaded before the views existed"""
+    for table, rollups in load_rollups().items():
+        for rollup, select in rollups:
+            if (client.command(f"SELECT count() FROM {database}.{rollup}") == 0
+                    and client.command(f"SELECT count() FROM {database}.{table}") > 0):
+                client.command(f"INSERT INTO {database}.{rollup} {in_database(select, database)}")
+                print(f"  Filled rollup {rollup} from {table}")
+
+def record_load(client, database, table, path, checksum, rows):
+    client.insert(
+        f"{database}.{MANIFEST_TABLE}",
+        [[table, os.path.basename(path), os.path.getsize(path), checksum, rows]],
+        column_names=['table_name', 'file_name', 'file_size', 'checksum', 'row_count'],
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Load OMOP CSV or Parquet files into ClickHouse in parallel.")
+    parser.add_argument('--data-dir', default='omop_data_csv',
+                        help="Directory with <table>.parquet or <table>.csv.gz files (default: omop_data_csv)")
+    parser.add_argument('--database', default=os.getenv("CLICKHOUSE_DB", "omop"),
+                        help="Target database (default: $CLICKHOUSE_DB or omop)")
+    parser.add_argument('--tables', nargs='+', default=None,
+                        help="Only load these tables (default: every table with a source file)")
+    parser.add_argument('--jobs', type=int, default=4,
+                        help="Number of tables inserted concurrently (default: 4)")
+    parser.add_argument('--block-size', type=int, default=1_000_000,
+                        help="Rows per block written by the server (default: 1000000)")
+    parser.add_argument('--insert-threads', type=int, default=4,
+                        help="Server threads writing each insert (default: 4)")
+    parser.add_argument('--profile', choices=SCHEMA_PROFILES, default='default',
+                        help="Schema profile of tables created by the loader; 'patient' sorts event tables "
+                             "by person, concept and date (default: default)")
+    parser.add_argument('--partition-by-year', action='store_true',
+                        help="With the patient profile, partition event tables by year")
+    parser.add_argument('--reload', action='store_true',
+                        help="Reload every table, even those that already match their source file")
+    args = parser.parse_args()
+
+    sources = find_source_files(args.data_dir, load_csv_formats())
+    if args.tables:
+        missing = sorted(set(args.tables) - set(sources))
+        if missing:
+            parser.error(f"No source file in {args.data_dir} for: {', '.join(missing)}")
+        sources = {table: sources[table] for table in args.tables}
+    if not sources:
+        print(f"No OMOP files found in {args.data_dir}!")
+        return
+
+    client = get_client()
+    try:
+        create_schema(client, args.database, args.profile, args.partition_by_year)
+    finally:
+        client.close()
+
+    settings = insert_settings(args.block_size, args.insert_threads, args.partition_by_year)
+    # Largest files first so they do not end up alone at the tail of the run
+    tables = sorted(sources, key=lambda table: os.path.getsize(sources[table][0]), reverse=True)
+    print(f"Loading {len(tables)} tables from {args.data_dir} into {args.database} with {args.jobs} jobs...")
+
+    results = {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.jobs) as executor:
+        futures = {
+            executor.submit(load_table, table, *sources[table], args.database, settings, args.reload): table
+            for table in tables
+        }
+        for future in as_completed(futures):
+            table = futures[future]
+            try:
+                status, rows, seconds = future.result()
+            except Exception as e:
+                status, rows, seconds = f"failed: {e}", 0, 0.0
+            results[table] = (status, rows, seconds)
+            print(f"  {table}: {status}, {rows} rows")
+    client = get_client()
+    try:
+        backfill_rollups(client, args.database)
+    finally:
+        client.close()
+    elapsed = time.perf_counter() - start
+
+    print("\nPer-table throughput (slowest first):")
+    for table, (status, rows, seconds) in sorted(results.items(), key=lambda item: item[1][2], reverse=True):
+        if status == 'loaded':
+            rate = rows / seconds if seconds else 0
+            print(f"  {table}: {rows} rows in {seconds:.2f}s ({rate:,.0f} rows/s) from {os.path.basename(sources[table][0])}")
+    total_rows = sum(rows for status, rows, _ in results.values() if status == 'loaded')
+    print(f"\nLoaded {total_rows} rows in {elapsed:.2f}s")
+    failed = [table for table, (status, _, _) in results.items() if status.startswith('failed')]
+    if failed:
+        raise SystemExit(f"Failed to load: {', '.join(sorted(failed))}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Embedded chDB engine answering the MCP server's queries in process, without a ClickHouse server.
+
+The OMOP files in the data directory are loaded into MergeTree tables of an on-disk chDB database,
+created from the same clickhouse-init.xml definitions as the ClickHouse container. The database
+is kept between runs and only tables whose source file changed are reloaded, so later starts take
+seconds. chDB is ClickHouse itself, so every tool query runs unchanged.
+"""
+
+import os
+import asyncio
+import logging
+import tempfile
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+
+from incremental import load_manifest, save_manifest
+from load_omop import find_source_files, in_database
+from omop_schema import load_create_queries, load_csv_formats, load_rollups, load_table_schemas
+
+try:
+    from chdb import session as chdb_session
+except ImportError:
+    chdb_session = None
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('clickhouse', 'chdb')
+
+# ClickHouse names of the Arrow types chDB returns, for the column types of results
+_ARROW_TYPES = {
+    'bool': 'Bool', 'int8': 'Int8', 'int16': 'Int16', 'int32': 'Int32', 'int64': 'Int64',
+    'uint8': 'UInt8', 'uint16': 'UInt16', 'uint32': 'UInt32', 'uint64': 'UInt64',
+    'float': 'Float32', 'double': 'Float64', 'string': 'String', 'large_string': 'String',
+    'binary': 'String', 'large_binary': 'String', 'date32': 'Date32',
+}
+
+def _sql_string(value):
+    """Quote a string as a ClickHouse literal"""
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+def _clickhouse_type(field):
+    name = _ARROW_TYPES.get(str(field.type))
+    if name is None:
+        name = 'DateTime64' if str(field.type).startswith('timestamp') else str(field.type)
+    return f"Nullable({name})" if field.nullable else name
+
+@dataclass
+class ColumnType:
+    name: str
+
+@dataclass
+class ResultSource:
+    """Result metadata, named like that of a clickhouse_connect stream"""
+    column_names: tuple
+    column_types: tuple
+    query_id: str
+    summary: dict
+
+@dataclass
+class QueryResult:
+    column_names: tuple
+    result_rows: list
+
+class SpooledResult:
+    """ArrowStream result of a query spooled to an anonymous temporary file, read back one record
+    batch at a time.
+
+    chDB writes nothing for a result without rows, so the column names and ClickHouse types of
+    an empty result are given by the caller.
+    """
+
+    def __init__(self, spool, summary, columns=()):
+        import pyarrow as pa
+
+        self.summary = summary
+        self._spool = spool
+        empty = spool.seek(0, os.SEEK_END) == 0
+        spool.seek(0)
+        self._reader = None if empty else pa.ipc.open_stream(spool)
+        if empty:
+            self.column_names = tuple(name for name, _ in columns)
+            self.column_types = tuple(column_type for _, column_type in columns)
+        else:
+            self.column_names = tuple(self._reader.schema.names)
+            self.column_types = tuple(_clickhouse_type(field) for field in self._reader.schema)
+
+    def batches(self, max_rows=65536):
+        if self._reader is None:
+            return
+        for batch in self._reader:
+            for offset in range(0, batch.num_rows, max_rows):
+                yield batch.slice(offset, max_rows)
+
+    def close(self):
+        self._spool.close()
+
+class BlockStream:
+    """Column blocks of a result, iterated like a clickhouse_connect column block stream"""
+
+    def __init__(self, source, result, block_size):
+        self.source = source
+        self._result = result
+        self._batches = result.batches(block_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._batches = iter(())
+        self._result.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch = next(self._batches)
+        while not batch.num_rows:
+            batch = next(self._batches)
+        return [column.to_pylist() for column in batch.columns]
+
+class LocalEngine:
+    """On-disk chDB database of the OMOP tables, running one statement at a time.
+
+    Query settings are applied to the session before each statement, and settings changed by an
+    earlier statement are put back to their defaults, so each query sees only its own settings.
+    Results are streamed from chDB to a temporary file while the statement runs, then read back
+    batch by batch, so memory is bounded by a batch and open cursors do not hold the engine.
+    """
+
+    def __init__(self, path, data_dir, database='omop', profile='default'):
+        self.path = path
+        self.data_dir = data_dir
+        self.database = database
+        self.profile = profile
+        self._session = None
+        self._spool_dir = os.path.join(path, 'result_spool')
+        self._lock = threading.Lock()
+        self._defaults = {}
+        self._current = {}
+
+    def open(self):
+        """Open the database, loading the tables whose source file changed since the last run"""
+        if chdb_session is None:
+            raise RuntimeError("OMOP_BACKEND=chdb requires chdb (pip install chdb)")
+        if not hasattr(chdb_session.Session, 'send_query'):
+            raise RuntimeError("OMOP_BACKEND=chdb requires a chdb version with streaming queries (pip install -U chdb)")
+        os.makedirs(self._spool_dir, exist_ok=True)
+        self._session = chdb_session.Session(self.path)
+        try:
+            # Strings as Arrow strings rather than bytes
+            self._session.query("SET output_format_arrow_string_as_string = 1")
+            with self._lock:
+                self.load()
+                self._session.query(f"USE {self.database}")
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def load(self):
+        """Create the OMOP tables and (re)load those whose source file is not the one loaded last"""
+        for query in load_create_queries(profile=self.profile):
+            self._session.query(in_database(query, self.database))
+        manifest = load_manifest(self.path)
+        schemas = load_table_schemas()
+        rollups = load_rollups()
+        for table, (path, fmt) in sorted(find_source_files(self.data_dir, load_csv_formats()).items()):
+            stat = os.stat(path)
+            source = {'file': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            if manifest.get(f"{self.database}.{table}") == source:
+                continue
+            start = time.perf_counter()
+            self._session.query(f"TRUNCATE TABLE {self.database}.{table}")
+            # The materialized views add the new rows to the rollups, which must not keep the old ones
+            for rollup, _ in rollups.get(table, []):
+                self._session.query(f"TRUNCATE TABLE {self.database}.{rollup}")
+            # With the column list of the table, as in the startup scripts of the ClickHouse container
+            structure = ', '.join(f"{column} {column_type}" for column, column_type in schemas[table])
+            self._session.query(
+                f"INSERT INTO {self.database}.{table} "
+                f"SELECT * FROM file({_sql_string(source['file'])}, {_sql_string(fmt)}, {_sql_string(structure)})"
+            )
+            logger.info("Loaded %s from %s in %.1fs", table, path, time.perf_counter() - start)
+            manifest[f"{self.database}.{table}"] = source
+            save_manifest(self.path, manifest)
+
+    def _apply_settings(self, settings):
+        for name in settings.keys() - self._defaults.keys():
+            result = self._session.query(
+                f"SELECT value FROM system.settings WHERE name = {_sql_string(name)}", 'TabSeparatedRaw')
+            self._defaults[name] = self._current[name] = result.bytes().decode().strip()
+        for name, value in {**self._defaults, **{name: str(value) for name, value in settings.items()}}.items():
+            if self._current[name] != value:
+                self._session.query(f"SET {name} = {_sql_string(value)}")
+                self._current[name] = value
+
+    def execute(self, query, settings=None):
+        """Run a query and return its SpooledResult"""
+        spool = tempfile.TemporaryFile(dir=self._spool_dir)
+        try:
+            with self._lock:
+                if self._session is None:
+                    raise RuntimeError("The local engine is closed")
+                self._apply_settings(settings or {})
+                start = time.perf_counter()
+                read_rows = read_bytes = 0
+                stream = self._session.send_query(query, 'ArrowStream')
+                try:
+                    for chunk in stream:
+                        spool.write(chunk.bytes())
+                        read_rows += chunk.rows_read()
+                        read_bytes += chunk.bytes_read()
+                finally:
+                    stream.close()
+                summary = {'read_rows': read_rows, 'read_bytes': read_bytes,
+                           'elapsed_ns': int((time.perf_counter() - start) * 1e9)}
+                columns = self._describe(query) if not spool.tell() else ()
+            return SpooledResult(spool, summary, columns)
+        except BaseException:
+            spool.close()
+            raise
+
+    def _describe(self, query):
+        """(name, type) of the columns of a query's result, empty for statements without one"""
+        import pyarrow as pa
+
+        try:
+            # On its own line, the closing parenthesis is not commented out by a trailing comment
+            data = self._session.query(f"DESCRIBE ({query.strip().rstrip(';')}\n)", 'ArrowStream').bytes()
+        except Exception:
+            return ()
+        if not data:
+            return ()
+        table = pa.ipc.open_stream(pa.py_buffer(data)).read_all()
+        return list(zip(table.column('name').to_pylist(), table.column('type').to_pylist()))
+
+    def query(self, query, settings=None):
+        """Run a query and return all its rows"""
+        result = self.execute(query, settings)
+        try:
+            rows = []
+            for batch in result.batches():
+                rows.extend(zip(*(column.to_pylist() for column in batch.columns)))
+            return QueryResult(result.column_names, rows)
+        finally:
+            result.close()
+
+class LocalClient:
+    """Async client of a LocalEngine with the subset of the clickhouse_connect API the server uses"""
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    async def query(self, query, settings=None):
+        return await asyncio.to_thread(self.engine.query, query, settings)
+
+    async def query_column_block_stream(self, query, settings=None):
+        settings = dict(settings or {})
+        block_size = settings.pop('max_block_size', 65536)
+        result = await asyncio.to_thread(self.engine.execute, query, settings)
+        source = ResultSource(
+            column_names=result.column_names,
+            column_types=tuple(ColumnType(column_type) for column_type in result.column_types),
+            query_id=str(uuid.uuid4()),
+            summary=result.summary,
+        )
+        return BlockStream(source, result, block_size)
+
+    async def ping(self):
+        return True
+
+    async def close(self):
+        pass
+
+def engine_from_env(database=None):
+    """LocalEngine configured by the OMOP_LOCAL_* variables"""
+    return LocalEngine(
+        path=os.getenv('OMOP_LOCAL_PATH', 'omop_local_db'),
+        data_dir=os.getenv('OMOP_LOCAL_DATA_DIR', 'omop_data_csv'),
+        database=database or os.getenv('CLICKHOUSE_DB', 'omop'),
+        profile=os.getenv('OMOP_LOCAL_PROFILE', 'default'),
+    )
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+OMOP table definitions read from clickhouse-init.xml, used by the preprocessing scripts
+to write typed Parquet files that ClickHouse loads without parsing CSV.
+"""
+
+import os
+import re
+import xml.etree.ElementTree as ET
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+INIT_XML = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'clickhouse-init.xml')
+
+OUTPUT_FORMATS = ('csv', 'parquet')
+
+SCHEMA_PROFILES = ('default', 'patient')
+
+# Event tables of the patient profile: (main concept column, start date column)
+EVENT_TABLES = {
+    'visit_occurrence': ('visit_concept_id', 'visit_start_date'),
+    'visit_detail': ('visit_detail_concept_id', 'visit_detail_start_date'),
+    'condition_occurrence': ('condition_concept_id', 'condition_start_date'),
+    'drug_exposure': ('drug_concept_id', 'drug_exposure_start_date'),
+    'procedure_occurrence': ('procedure_concept_id', 'procedure_date'),
+    'device_exposure': ('device_concept_id', 'device_exposure_start_date'),
+    'measurement': ('measurement_concept_id', 'measurement_date'),
+    'observation': ('observation_concept_id', 'observation_date'),
+    'specimen': ('specimen_concept_id', 'specimen_date'),
+    'condition_era': ('condition_concept_id', 'condition_era_start_date'),
+    'drug_era': ('drug_concept_id', 'drug_era_start_date'),
+    'dose_era': ('drug_concept_id', 'dose_era_start_date'),
+    'observation_period': (None, 'observation_period_start_date'),
+}
+
+# Source values holding free text or numbers rather than codes, kept as plain String
+HIGH_CARDINALITY_SOURCE_VALUES = {'value_source_value'}
+
+PARQUET_COMPRESSION = 'zstd'
+PARQUET_ROW_GROUP_SIZE = 1_000_000
+
+_CREATE_TABLE = re.compile(r"CREATE TABLE IF NOT EXISTS \w+\.(\w+)\s*\((.*?)\)\s*ENGINE", re.S)
+_COLUMN = re.compile(r"^\s*(\w+)\s+(.+?),?\s*$")
+_MATERIALIZED_VIEW = re.compile(r"CREATE MATERIALIZED VIEW IF NOT EXISTS \w+\.\w+ TO \w+\.(\w+) AS (SELECT .* FROM \w+\.(\w+) .*)")
+_CSV_INSERT = re.compile(r"INSERT INTO \w+\.(\w+) SELECT \* FROM file\('[^']*\.csv\.gz', '(\w+)'")
+
+def _queries(path):
+    return [' '.join(query.text.split()) for query in ET.parse(path).getroot().iter('query') if query.text]
+
+@lru_cache(maxsize=None)
+def load_table_schemas(path=INIT_XML):
+    """Return {table: [(column, ClickHouse type), ...]} from the CREATE TABLE startup scripts"""
+    schemas = {}
+    for query in ET.parse(path).getroot().iter('query'):
+        match = _CREATE_TABLE.search(query.text or '')
+        if not match:
+            continue
+        columns = []
+        for line in match.group(2).splitlines():
+            column = _COLUMN.match(line)
+            if column:
+                columns.append((column.group(1), column.group(2)))
+        schemas[match.group(1)] = columns
+    return schemas
+
+def load_create_queries(path=INIT_XML, profile='default', partition_by_year=False):
+    """Return the CREATE DATABASE and CREATE TABLE startup queries, in order"""
+    return [apply_profile(query, profile, partition_by_year) for query in _queries(path) if query.startswith('CREATE ')]
+
+def load_csv_formats(path=INIT_XML):
+    """Return {table: input format} of the CSV files loaded by the startup scripts"""
+    formats = {}
+    for query in _queries(path):
+        match = _CSV_INSERT.match(query)
+        if match:
+            formats[match.group(1)] = match.group(2)
+    return formats
+
+def skip_indexes(table, columns):
+    """Skip index definitions of an event table in the patient profile"""
+    concept_col, date_col = EVENT_TABLES[table]
+    indexes = []
+    for col in columns:
+        if col == concept_col or col.endswith('_source_concept_id'):
+            indexes.append(f"INDEX idx_{col} {col} TYPE bloom_filter(0.01) GRANULARITY 4")
+        elif col.endswith('_type_concept_id'):
+            indexes.append(f"INDEX idx_{col} {col} TYPE set(100) GRANULARITY 4")
+    indexes.append(f"INDEX idx_{date_col} {date_col} TYPE minmax GRANULARITY 1")
+    return indexes
+
+def apply_profile(query, profile='default', partition_by_year=False):
+    """Rewrite a CREATE TABLE query for a schema profile.
+
+    The patient profile sorts event tables by (person_id, concept, start date) instead of their own ID,
+    which is what cohort and timeline queries filter on, adds skip indexes on concept IDs and stores
+    source value codes as LowCardinality(String). Other tables and queries are returned unchanged.
+    """
+    if profile not in SCHEMA_PROFILES:
+        raise ValueError(f"Unknown schema profile {profile!r}, expected one of {SCHEMA_PROFILES}")
+    match = _CREATE_TABLE.search(query)
+    if profile == 'default' or not match or match.group(1) not in EVENT_TABLES:
+        return query
+    table, body = match.group(1), match.group(2)
+    concept_col, date_col = EVENT_TABLES[table]
+
+    body = re.sub(
+        r"\b(\w+_source_value) String\b",
+        lambda m: m.group(0) if m.group(1) in HIGH_CARDINALITY_SOURCE_VALUES else f"{m.group(1)} LowCardinality(String)",
+        body,
+    )
+    indent = re.search(r"\n([ \t]*)\S", body)
+    separator = f",\n{indent.group(1)}" if indent else ", "
+    columns = [col for col, _ in load_table_schemas().get(table, [])]
+    stripped = body.rstrip()
+    body = stripped + separator + separator.join(skip_indexes(table, columns)) + body[len(stripped):]
+
+    sort_key = ', '.join(col for col in ('person_id', concept_col, date_col) if col)
+    tail = query[match.end(2):]
+    tail = re.sub(
+        r"PRIMARY KEY \([^)]*\)(\s*)",
+        lambda m: f"PARTITION BY toYear({date_col}){m.group(1)}" if partition_by_year else "",
+        tail,
+    )
+    tail = re.sub(r"ORDER BY \([^)]*\)", lambda m: f"ORDER BY ({sort_key})", tail)
+    return query[:match.start(2)] + body + tail
+
+def write_init_xml(output, profile='default', partition_by_year=False, path=INIT_XML):
+    """Write a copy of clickhouse-init.xml with its CREATE TABLE queries rewritten for a profile"""
+    with open(path) as f:
+        text = f.read()
+    for query in ET.parse(path).getroot().iter('query'):
+        if query.text and _CREATE_TABLE.search(query.text):
+            text = text.replace(query.text, apply_profile(query.text, profile, partition_by_year))
+    if partition_by_year:
+        # Data spanning a century touches more partitions per insert than the default limit of 100
+        text = re.sub(r"(SELECT \* FROM file\([^<]*\)) SETTINGS ", r"\1 SETTINGS max_partitions_per_insert_block=0, ", text)
+        text = re.sub(r"(SELECT \* FROM file\([^<]*'gz'\))</query>", r"\1 SETTINGS max_partitions_per_insert_block=0</query>", text)
+    with open(output, 'w') as f:
+        f.write(text)
+
+def load_rollups(path=INIT_XML):
+    """Return {source table: [(rollup table, SELECT filling it), ...]} for the materialized views"""
+    rollups = {}
+    for query in _queries(path):
+        match = _MATERIALIZED_VIEW.match(query)
+        if match:
+            rollups.setdefault(match.group(3), []).append((match.group(1), match.group(2)))
+    return rollups
+
+def output_filename(table_name, output_format):
+    """File name of a table in the given output format"""
+    if output_format == 'parquet':
+        return f"{table_name}.parquet"
+    return f"{table_name}.csv.gz"
+
+def check_output_format(output_format):
+    """Raise ValueError if the output format is unknown or its dependencies are missing"""
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {output_format!r}, expected one of {OUTPUT_FORMATS}")
+    if output_format == 'parquet':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ValueError("The 'parquet' output format requires pyarrow (pip install pyarrow)") from None
+
+def arrow_type(ch_type):
+    """Arrow type matching a ClickHouse column type, String for anything unknown"""
+    import pyarrow as pa
+
+    ch_type = re.sub(r"^(Nullable|LowCardinality)\((.*)\)$", r"\2", ch_type)
+    types = {
+        'UInt8': pa.uint8(), 'UInt16': pa.uint16(), 'UInt32': pa.uint32(), 'UInt64': pa.uint64(),
+        'Int8': pa.int8(), 'Int16': pa.int16(), 'Int32': pa.int32(), 'Int64': pa.int64(),
+        'Float32': pa.float32(), 'Float64': pa.float64(), 'Bool': pa.bool_(),
+        'Date': pa.date32(), 'Date32': pa.date32(),
+    }
+    if ch_type in types:
+        return types[ch_type]
+    if ch_type.startswith('DateTime64'):
+        # DateTime64 defaults to millisecond precision
+        precision = re.match(r"DateTime64\((\d)", ch_type)
+        return pa.timestamp({0: 's', 3: 'ms', 6: 'us', 9: 'ns'}.get(int(precision.group(1)) if precision else 3, 'ms'))
+    if ch_type.startswith('DateTime'):
+        return pa.timestamp('s')
+    return pa.string()
+
+def to_arrow_array(values, pa_type):
+    """Convert a column read from CSV to the given Arrow type, with unparsable values as nulls"""
+    import pyarrow as pa
+
+    if pa.types.is_integer(pa_type):
+        import pyarrow.compute as pc
+
+        numbers = pd.to_numeric(values, errors='coerce')
+        info = np.iinfo(pa_type.to_pandas_dtype())
+        # Fractions, negatives in unsigned columns and overflows become nulls instead of wrapping around
+        valid = numbers.notna() & (numbers == np.floor(numbers)) & (numbers >= info.min) & (numbers <= info.max)
+        array = pa.array(numbers, from_pandas=True)
+        return pc.if_else(pa.array(valid.to_numpy()), array, pa.scalar(None, array.type)).cast(pa_type)
+    if pa.types.is_floating(pa_type):
+        return pa.array(pd.to_numeric(values, errors='coerce').astype('float64'), from_pandas=True).cast(pa_type)
+    if pa.types.is_date(pa_type) or pa.types.is_timestamp(pa_type):
+        if not pd.api.types.is_datetime64_any_dtype(values):
+            values = pd.to_datetime(values, errors='coerce', format='mixed')
+        return pa.array(values, from_pandas=True).cast(pa_type, safe=False)
+    values = values.astype(object).where(values.isna(), values.astype(str))
+    return pa.array(values, type=pa.string(), from_pandas=True)
+
+def to_arrow_table(df, table_name):
+    """Convert a dataframe to an Arrow table typed after the ClickHouse definition of the table"""
+    import pyarrow as pa
+
+    types = dict(load_table_schemas().get(table_name, []))
+    arrays = [to_arrow_array(df[col], arrow_type(types.get(col, 'String'))) for col in df.columns]
+    return pa.Table.from_arrays(arrays, names=[str(col) for col in df.columns])
+
+class ParquetTableWriter:
+    """Write dataframes, e.g. the chunks of a streamed file, to one zstd-compressed Parquet file"""
+
+    def __init__(self, path, table_name):
+        self.path = path
+        self.table_name = table_name
+        self._writer = None
+
+    def write(self, df):
+        import pyarrow.parquet as pq
+
+        table = to_arrow_table(df, self.table_name)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path, table.schema, compression=PARQUET_COMPRESSION)
+        self._writer.write_table(table, row_group_size=PARQUET_ROW_GROUP_SIZE)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def write_parquet(df, table_name, path):
+    """Write a dataframe to a typed, zstd-compressed Parquet file"""
+    with ParquetTableWriter(path, table_name) as writer:
+        writer.write(df)
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Write clickhouse-init.xml for another schema profile.")
+    parser.add_argument('--profile', choices=SCHEMA_PROFILES, default='patient',
+                        help="Schema profile (default: patient)")
+    parser.add_argument('--partition-by-year', action='store_true',
+                        help="Partition event tables by the year of their start date")
+    parser.add_argument('--output', default='clickhouse-init.patient.xml',
+                        help="Output file (default: clickhouse-init.patient.xml)")
+    args = parser.parse_args()
+    write_init_xml(args.output, args.profile, args.partition_by_year)
+    print(f"Wrote {args.profile} schema to {args.output}")
+
+if __name__ == "__main__":
+    main()
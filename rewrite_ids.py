@@ -5,11 +5,19 @@ while maintaining referential integrity. Excludes concept_id and vocabulary-rela
 """
 
 import os
+import argparse
+import contextlib
 import gzip
+import io
+import time
+import numpy as np
 import pandas as pd
 import tempfile
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import shutil
+from incremental import iter_appended_rows, load_manifest, plan_file, record_output, save_manifest
+from omop_schema import OUTPUT_FORMATS, ParquetTableWriter, check_output_format, output_filename, write_parquet
 
 # Define which columns contain IDs that need to be rewritten
 # Format: {table_name: [list_of_id_columns]}
@@ -140,33 +148,254 @@ def read_csv_file(file_path):
             print(f"Error reading {file_path}: {e2}")
             return None
 
-def create_id_mappings(df, id_columns):
-    """Create mappings from old IDs to new sequential IDs"""
+class IdMapping:
+    """Mapping from old IDs to new sequential IDs backed by sorted NumPy arrays.
+
+    Old IDs are kept sorted next to the new ID assigned to each of them, which takes
+    16 bytes per entry instead of a boxed Python dict entry, and lookups are a
+    vectorized binary search. New IDs are numbered in order of first appearance.
+    Arrays can be saved to .npy files and reopened memory-mapped, so mappings spill
+    to disk and are reused by later runs.
+
+    New keys are collected chunk by chunk and merged into the sorted arrays in one pass
+    when they are needed, or once as many are pending as the mapping holds, rather
+    than copying the whole mapping for every chunk.
+    """
+
+    # Pending keys merged at the latest once there are this many, or as many as mapped keys
+    MERGE_MIN_PENDING = 1_000_000
+
+    def __init__(self, keys=None, ids=None):
+        self.keys = np.empty(0, dtype='int64') if keys is None else keys
+        self.ids = np.empty(0, dtype='int64') if ids is None else ids
+        # Keys not mapped when they were seen, in order of appearance, possibly repeated
+        self._pending = []
+        self._pending_size = 0
+
+    def __len__(self):
+        self._merge()
+        return len(self.keys)
+
+    @staticmethod
+    def _as_keys(values):
+        """Convert a Series of non-null IDs to a key array"""
+        values = pd.Series(values)
+        if pd.api.types.is_numeric_dtype(values):
+            keys = values.to_numpy()
+            if keys.dtype.kind == 'f' and not np.array_equal(keys, np.floor(keys)):
+                raise ValueError(f"Non-integer IDs cannot be rewritten: {keys[keys != np.floor(keys)][:5]}")
+            return keys.astype('int64')
+        return values.astype(str).to_numpy(dtype=str)
+
+    def _find(self, keys):
+        """Positions of keys in the sorted key array and whether each key is present"""
+        if len(self.keys) and self.keys.dtype.kind != keys.dtype.kind:
+            if self.keys.dtype.kind == 'U':
+                keys = keys.astype(str)
+            else:
+                # String IDs only match numeric keys when they are integers
+                numbers = pd.to_numeric(pd.Series(keys), errors='coerce')
+                valid = (numbers.notna() & (numbers == np.floor(numbers))).to_numpy()
+                positions, found = self._find(numbers.where(valid, 0).to_numpy().astype('int64'))
+                return positions, found & valid
+        positions = np.searchsorted(self.keys, keys)
+        found = np.zeros(len(keys), dtype=bool)
+        in_bounds = positions < len(self.keys)
+        found[in_bounds] = self.keys[positions[in_bounds]] == keys[in_bounds]
+        return positions, found
+
+    def extend(self, values):
+        """Assign new IDs to the values not mapped yet, in order of first appearance"""
+        uniques = self._as_keys(pd.unique(pd.Series(values).dropna()))
+        if not len(uniques):
+            return
+        if not len(self.keys) and not self._pending:
+            self.keys = self.keys.astype(uniques.dtype)
+        elif self.keys.dtype.kind != uniques.dtype.kind:
+            if uniques.dtype.kind == 'U':
+                # String IDs appeared after numeric ones: keep every key as a string, sorted as such
+                self._merge()
+                keys = self.keys.astype(str)
+                order = np.argsort(keys, kind='stable')
+                self.keys, self.ids = keys[order], np.asarray(self.ids)[order]
+            else:
+                uniques = uniques.astype(str)
+        _, found = self._find(uniques)
+        self._pending.append(uniques[~found])
+        self._pending_size += int((~found).sum())
+        if self._pending_size >= max(len(self.keys), self.MERGE_MIN_PENDING):
+            self._merge()
+
+    def _merge(self):
+        """Merge the pending keys into the sorted arrays, numbering them in order of first appearance"""
+        if not self._pending:
+            return
+        pending = np.concatenate(self._pending)
+        self._pending, self._pending_size = [], 0
+        # Sorted, with the first appearance of each key first
+        order = np.argsort(pending, kind='stable')
+        pending = pending[order]
+        first = np.ones(len(pending), dtype=bool)
+        first[1:] = pending[1:] != pending[:-1]
+        new_keys, appearance = pending[first], order[first]
+        new_ids = np.empty(len(new_keys), dtype='int64')
+        new_ids[np.argsort(appearance)] = np.arange(len(self.keys) + 1, len(self.keys) + len(new_keys) + 1)
+        # Merge the two sorted arrays, each new key goes before the mapped keys greater than it.
+        # The merged dtype is wide enough for the longest string key of either.
+        positions = np.searchsorted(self.keys, new_keys) + np.arange(len(new_keys))
+        keys = np.empty(len(self.keys) + len(new_keys), dtype=np.result_type(self.keys, new_keys))
+        ids = np.empty(len(keys), dtype='int64')
+        mapped = np.ones(len(keys), dtype=bool)
+        mapped[positions] = False
+        keys[positions], ids[positions] = new_keys, new_ids
+        keys[mapped], ids[mapped] = self.keys, self.ids
+        self.keys, self.ids = keys, ids
+
+    def lookup(self, values):
+        """Map a Series of old IDs to new IDs, missing and unknown IDs become <NA>"""
+        self._merge()
+        values = pd.Series(values)
+        result = np.zeros(len(values), dtype='int64')
+        mask = values.notna().to_numpy()
+        if len(self.keys) and mask.any():
+            positions, found = self._find(self._as_keys(values[mask]))
+            mapped = np.zeros(len(positions), dtype='int64')
+            mapped[found] = self.ids[positions[found]]
+            result[mask] = mapped
+            mask[mask] = found
+        else:
+            mask[:] = False
+        return pd.Series(pd.arrays.IntegerArray(result, ~mask), index=values.index)
+
+    def save(self, path):
+        """Write the mapping next to `path` and reopen it memory-mapped"""
+        self._merge()
+        np.save(f"{path}.keys.npy", self.keys)
+        np.save(f"{path}.ids.npy", self.ids)
+        return IdMapping.load(path)
+
+    @classmethod
+    def load(cls, path):
+        """Open a saved mapping memory-mapped, or return None if there is none"""
+        if not os.path.exists(f"{path}.keys.npy"):
+            return None
+        return cls(np.load(f"{path}.keys.npy", mmap_mode='r'), np.load(f"{path}.ids.npy", mmap_mode='r'))
+
+def mapping_path(mapping_dir, table_name, col):
+    return os.path.join(mapping_dir, f"{table_name}.{col}")
+
+def load_id_mappings(mapping_dir, table_name, id_columns):
+    """Load the persisted mappings of a table"""
     mappings = {}
+    for col in id_columns:
+        mapping = IdMapping.load(mapping_path(mapping_dir, table_name, col))
+        if mapping is not None:
+            mappings[col] = mapping
+    return mappings
+
+def save_id_mappings(mapping_dir, table_name, mappings):
+    """Persist the mappings of a table and return them memory-mapped"""
+    os.makedirs(mapping_dir, exist_ok=True)
+    return {col: mapping.save(mapping_path(mapping_dir, table_name, col)) for col, mapping in mappings.items()}
+
+def iter_csv_chunks(file_path, chunksize):
+    """Read a gzipped CSV file in chunks of `chunksize` rows, falling back to tabs like read_csv_file"""
+    try:
+        reader = pd.read_csv(file_path, compression='gzip', chunksize=chunksize)
+        first = next(reader, None)
+    except Exception:
+        try:
+            reader = pd.read_csv(file_path, compression='gzip', sep='\t', chunksize=chunksize)
+            first = next(reader, None)
+        except Exception as e2:
+            print(f"Error reading {file_path}: {e2}")
+            return
+    if first is None:
+        return
+    yield first
+    yield from reader
+
+def collect_id_mappings(chunks, id_columns, mappings=None):
+    """Build the same mappings as create_id_mappings from the chunks of a file"""
+    mappings = dict(mappings or {})
+    read_any = False
+    for chunk in chunks:
+        read_any = True
+        for col in id_columns:
+            if col in chunk.columns:
+                # New IDs are numbered in order of first appearance, as in a single pass
+                mappings.setdefault(col, IdMapping()).extend(chunk[col])
+    if not read_any:
+        return None
+
+    mappings = {col: mapping for col, mapping in mappings.items() if mapping}
+    for col, mapping in mappings.items():
+        print(f"  {col}: {len(mapping)} unique values mapped to 1-{len(mapping)}")
+    return mappings
+
+def create_id_mappings(df, id_columns, mappings=None):
+    """Create mappings from old IDs to new sequential IDs, extending existing mappings if given"""
+    mappings = dict(mappings or {})
     
     for col in id_columns:
         if col in df.columns:
-            # Get unique non-null values
-            unique_values = df[col].dropna().unique()
-            if len(unique_values) > 0:
-                # Create mapping from old to new sequential IDs
-                new_ids = range(1, len(unique_values) + 1)
-                mappings[col] = dict(zip(unique_values, new_ids))
-                print(f"  {col}: {len(unique_values)} unique values mapped to 1-{len(unique_values)}")
+            # Map unique non-null values to new sequential IDs
+            mapping = mappings.setdefault(col, IdMapping())
+            mapping.extend(df[col])
+            if len(mapping) > 0:
+                print(f"  {col}: {len(mapping)} unique values mapped to 1-{len(mapping)}")
+            else:
+                del mappings[col]
     
     return mappings
 
 def apply_id_mappings(df, mappings):
-    """Apply ID mappings to the dataframe"""
-    df_copy = df.copy()
-    
+    """Apply ID mappings to the dataframe in place and return it"""
     for col, mapping in mappings.items():
-        if col in df_copy.columns:
-            df_copy[col] = df_copy[col].map(mapping)
-            # Ensure the column is integer type, not float
-            df_copy[col] = pd.to_numeric(df_copy[col], errors='coerce').astype('Int64')
+        if col in df.columns:
+            df[col] = mapping.lookup(df[col])
     
-    return df_copy
+    return df
+
+def apply_cross_table_mappings(df, table_name, all_mappings):
+    """Apply mappings of columns referencing another table's IDs, return the applied references"""
+    applied = []
+    cross_table_ids = CROSS_TABLE_IDS.get(table_name, {})
+    for col, (ref_table, ref_col) in cross_table_ids.items():
+        if col in df.columns and ref_table in all_mappings and ref_col in all_mappings[ref_table]:
+            ref_mapping = all_mappings[ref_table][ref_col]
+            df[col] = ref_mapping.lookup(df[col])
+            applied.append((col, ref_table, ref_col))
+    return applied
+
+def rewrite_csv_file_streaming(file_path, output_dir, table_name, all_mappings, chunksize, output_format='csv',
+                               append_from=None):
+    """Rewrite IDs chunk by chunk, writing each chunk straight to the output file.
+
+    With `append_from`, only the rows starting at that offset of the decompressed file are rewritten,
+    and appended to the existing gzipped CSV output as a new gzip member.
+    """
+    output_path = os.path.join(output_dir, output_filename(table_name, output_format))
+    applied = []
+    if append_from is not None:
+        chunks = iter_appended_rows(file_path, append_from, chunksize=chunksize)
+    else:
+        chunks = iter_csv_chunks(file_path, chunksize)
+    if output_format == 'parquet':
+        writer = ParquetTableWriter(output_path, table_name)
+    else:
+        writer = gzip.open(output_path, 'wt' if append_from is None else 'at', newline='')
+    with writer:
+        for i, chunk in enumerate(chunks):
+            apply_id_mappings(chunk, all_mappings[table_name])
+            applied = apply_cross_table_mappings(chunk, table_name, all_mappings)
+            if output_format == 'parquet':
+                writer.write(chunk)
+            else:
+                chunk.to_csv(writer, index=False, header=(i == 0 and append_from is None))
+    for col, ref_table, ref_col in applied:
+        print(f"  Applied cross-table mapping: {col} -> {ref_table}.{ref_col}")
+    print(f"  Saved: {output_path}")
 
 def save_csv_file(df, file_path, output_dir):
     """Save dataframe to gzipped CSV file in output directory"""
@@ -178,7 +407,165 @@ def save_csv_file(df, file_path, output_dir):
     df.to_csv(output_path, index=False, compression='gzip')
     print(f"  Saved: {output_path}")
 
+def save_parquet_file(df, table_name, output_dir):
+    """Save dataframe to a typed Parquet file in output directory"""
+    output_path = os.path.join(output_dir, output_filename(table_name, 'parquet'))
+    write_parquet(df, table_name, output_path)
+    print(f"  Saved: {output_path}")
+
+def collect_table_mappings(table_name, file_path, chunksize=None, mapping_dir=None, append_from=None):
+    """Phase 1 for one table: build the mappings of its ID columns, persisting them if mapping_dir is set.
+
+    With `append_from`, the persisted mappings are only extended with the rows starting at that offset.
+    """
+    # Get ID columns for this table
+    id_cols = ID_COLUMNS.get(table_name, [])
+    if not id_cols:
+        print(f"  No ID columns defined for {table_name}, skipping...")
+        return None
+    
+    # Filter out excluded columns
+    id_cols = [col for col in id_cols if col not in EXCLUDED_COLUMNS]
+    if not id_cols:
+        print(f"  All ID columns for {table_name} are excluded, skipping...")
+        return None
+    
+    print(f"  ID columns to rewrite: {id_cols}")
+    
+    existing = load_id_mappings(mapping_dir, table_name, id_cols) if mapping_dir else {}
+    if existing:
+        print(f"  Reusing persisted mappings for: {list(existing)}")
+    
+    # Create mappings for this table
+    if append_from is not None:
+        mappings = collect_id_mappings(iter_appended_rows(file_path, append_from, chunksize=chunksize),
+                                       id_cols, existing)
+        if mappings is None:
+            return None
+    elif chunksize:
+        mappings = collect_id_mappings(iter_csv_chunks(file_path, chunksize), id_cols, existing)
+        if mappings is None:
+            return None
+    else:
+        df = read_csv_file(file_path)
+        if df is None:
+            return None
+        mappings = create_id_mappings(df, id_cols, existing)
+    if mapping_dir:
+        mappings = save_id_mappings(mapping_dir, table_name, mappings)
+    return mappings
+
+def rewrite_table(table_name, file_path, output_dir, all_mappings, chunksize=None, output_format='csv',
+                  append_from=None):
+    """Phase 2 for one table: rewrite its IDs and save it to the output directory, or with
+    `append_from` only append the rows starting at that offset to it"""
+    mappings = all_mappings.get(table_name, {})
+    if not mappings:
+        print(f"  No mappings for {table_name}, skipping...")
+        return
+    
+    if chunksize or append_from is not None:
+        rewrite_csv_file_streaming(file_path, output_dir, table_name, all_mappings, chunksize, output_format,
+                                   append_from)
+        return
+    
+    df = read_csv_file(file_path)
+    if df is None:
+        return
+    
+    # Apply mappings for regular ID columns
+    df_new = apply_id_mappings(df, mappings)
+    
+    # Apply cross-table ID mappings
+    for col, ref_table, ref_col in apply_cross_table_mappings(df_new, table_name, all_mappings):
+        print(f"  Applied cross-table mapping: {col} -> {ref_table}.{ref_col}")
+    
+    # Save the file
+    if output_format == 'parquet':
+        save_parquet_file(df_new, table_name, output_dir)
+    else:
+        save_csv_file(df_new, file_path, output_dir)
+
+def run_captured(func, *args):
+    """Run func capturing what it prints, return (result, output, seconds)"""
+    start = time.perf_counter()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        result = func(*args)
+    return result, output.getvalue(), time.perf_counter() - start
+
+def collect_table_columns(table_name, file_path, chunksize, mapping_dir, append_from=None):
+    """Phase 1 in a worker: persist the mappings and only send back the mapped columns"""
+    mappings = collect_table_mappings(table_name, file_path, chunksize, mapping_dir, append_from)
+    return None if mappings is None else list(mappings)
+
+def rewrite_table_from_dir(table_name, file_path, output_dir, mapped_columns, chunksize, mapping_dir,
+                           output_format='csv', append_from=None):
+    """Phase 2 in a worker: open the mappings this table needs memory-mapped and rewrite it"""
+    tables = {table_name} | {ref_table for ref_table, _ in CROSS_TABLE_IDS.get(table_name, {}).values()}
+    all_mappings = {
+        table: load_id_mappings(mapping_dir, table, mapped_columns[table])
+        for table in tables if table in mapped_columns
+    }
+    rewrite_table(table_name, file_path, output_dir, all_mappings, chunksize, output_format, append_from)
+
+def plan_tables(csv_files, output_dir, mapping_dir, manifest, output_format):
+    """For --incremental, decide per table whether it can be skipped, only needs its appended rows
+    rewritten, or must be rewritten whole. Returns {table: (action, manifest entry, offset, mapped columns)}"""
+    plans = {}
+    for table_name, file_path in csv_files:
+        previous = manifest.get(os.path.basename(file_path))
+        output_path = os.path.join(output_dir, output_filename(table_name, output_format))
+        action, entry, offset = plan_file(file_path, previous, output_path, output_format)
+        mapped_columns = previous.get('mapped_columns') if previous else None
+        if (action != 'full' and mapped_columns
+                and len(load_id_mappings(mapping_dir, table_name, mapped_columns)) < len(mapped_columns)):
+            # The mappings the output was written with are gone
+            action, offset = 'full', None
+        if action == 'append' and table_name in CROSS_TABLE_IDS:
+            # Rows already written may reference IDs that only appear in the appended rows
+            action, offset = 'full', None
+        plans[table_name] = (action, entry, offset, mapped_columns)
+    return plans
+
+def run_parallel(tasks, jobs):
+    """Run (table_name, func, args) tasks in a process pool, print their output as they finish"""
+    results, timings = {}, {}
+    with ProcessPoolExecutor(jobs) as executor:
+        futures = {executor.submit(run_captured, func, *args): table_name for table_name, func, args in tasks}
+        for future in as_completed(futures):
+            table_name = futures[future]
+            result, output, seconds = future.result()
+            print(f"\nProcessing {table_name}...")
+            print(output, end='')
+            results[table_name] = result
+            timings[table_name] = seconds
+    return results, timings
+
 def main():
+    parser = argparse.ArgumentParser(description="Rewrite OMOP IDs to small sequential integers.")
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help="Stream files in chunks of this many rows so tables larger than memory "
+                             "can be processed (default: load each file whole)")
+    parser.add_argument('--mapping-dir', default=None,
+                        help="Persist ID mappings as memory-mapped arrays in this directory and reuse "
+                             "them on later runs, so reruns and new batches keep the same new IDs")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Keep a manifest of processed files in --mapping-dir and only process new or "
+                             "changed files, and only the rows appended to a file since the last run")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="Number of worker processes handling tables in parallel (default: 1)")
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='csv',
+                        help="Write gzipped CSV, or typed zstd Parquet that ClickHouse loads without "
+                             "parsing text (default: csv)")
+    args = parser.parse_args()
+    try:
+        check_output_format(args.output_format)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.incremental and not args.mapping_dir:
+        parser.error("--incremental needs --mapping-dir, where the mappings it reuses are kept")
+
     print("Starting ID rewriting process...")
     print("This will maintain referential integrity while using smaller sequential IDs.")
     print()
@@ -196,65 +583,86 @@ def main():
         print(f"  - {table_name}: {file_path}")
     print()
     
-    # First pass: collect all ID mappings
-    all_mappings = {}
+    # Largest tables first so they do not end up alone at the tail of the run
+    csv_files.sort(key=lambda item: os.path.getsize(item[1]), reverse=True)
+    timings = defaultdict(lambda: [0.0, 0.0])
     
-    print("Phase 1: Collecting ID mappings...")
-    for table_name, file_path in csv_files:
-        print(f"\nProcessing {table_name}...")
-        
-        df = read_csv_file(file_path)
-        if df is None:
-            continue
+    manifest, plans = {}, {}
+    if args.incremental:
+        manifest = load_manifest(args.mapping_dir)
+        plans = plan_tables(csv_files, output_dir, args.mapping_dir, manifest, args.output_format)
+    offsets = {table_name: plan[2] for table_name, plan in plans.items()}
+    # Unchanged tables keep their output, and only their mapped columns are needed
+    skipped = {table_name: plan[3] for table_name, plan in plans.items() if plan[0] == 'skip'}
+    if skipped:
+        print(f"Skipping {len(skipped)} unchanged tables: {', '.join(sorted(skipped))}")
+        print()
+    to_process = [(table_name, file_path) for table_name, file_path in csv_files if table_name not in skipped]
+    
+    if args.jobs > 1:
+        # Workers share mappings through memory-mapped files instead of pickling them around
+        mapping_dir = args.mapping_dir or tempfile.mkdtemp(prefix="omop_id_mappings_")
+        try:
+            print("Phase 1: Collecting ID mappings...")
+            mapped_columns, phase_timings = run_parallel(
+                [(table_name, collect_table_columns,
+                  (table_name, file_path, args.chunksize, mapping_dir, offsets.get(table_name)))
+                 for table_name, file_path in to_process], args.jobs)
+            mapped_columns.update(skipped)
+            mapped_columns = {table: cols for table, cols in mapped_columns.items() if cols is not None}
+            for table_name, seconds in phase_timings.items():
+                timings[table_name][0] = seconds
+            
+            print("\nPhase 2: Applying ID mappings...")
+            _, phase_timings = run_parallel(
+                [(table_name, rewrite_table_from_dir,
+                  (table_name, file_path, output_dir, mapped_columns, args.chunksize, mapping_dir,
+                   args.output_format, offsets.get(table_name)))
+                 for table_name, file_path in to_process], args.jobs)
+            for table_name, seconds in phase_timings.items():
+                timings[table_name][1] = seconds
+        finally:
+            if not args.mapping_dir:
+                shutil.rmtree(mapping_dir, ignore_errors=True)
+    else:
+        # First pass: collect all ID mappings
+        all_mappings = {}
         
-        # Get ID columns for this table
-        id_cols = ID_COLUMNS.get(table_name, [])
-        if not id_cols:
-            print(f"  No ID columns defined for {table_name}, skipping...")
-            continue
+        for table_name, cols in skipped.items():
+            if cols:
+                all_mappings[table_name] = load_id_mappings(args.mapping_dir, table_name, cols)
         
-        # Filter out excluded columns
-        id_cols = [col for col in id_cols if col not in EXCLUDED_COLUMNS]
-        if not id_cols:
-            print(f"  All ID columns for {table_name} are excluded, skipping...")
-            continue
+        print("Phase 1: Collecting ID mappings...")
+        for table_name, file_path in to_process:
+            print(f"\nProcessing {table_name}...")
+            start = time.perf_counter()
+            mappings = collect_table_mappings(table_name, file_path, args.chunksize, args.mapping_dir,
+                                              offsets.get(table_name))
+            timings[table_name][0] = time.perf_counter() - start
+            if mappings is not None:
+                all_mappings[table_name] = mappings
         
-        print(f"  ID columns to rewrite: {id_cols}")
+        print(f"\nPhase 2: Applying ID mappings...")
         
-        # Create mappings for this table
-        mappings = create_id_mappings(df, id_cols)
-        all_mappings[table_name] = mappings
+        # Second pass: apply mappings
+        for table_name, file_path in to_process:
+            print(f"\nProcessing {table_name}...")
+            start = time.perf_counter()
+            rewrite_table(table_name, file_path, output_dir, all_mappings, args.chunksize, args.output_format,
+                          offsets.get(table_name))
+            timings[table_name][1] = time.perf_counter() - start
+        mapped_columns = {table_name: list(mappings) for table_name, mappings in all_mappings.items()}
     
-    print(f"\nPhase 2: Applying ID mappings...")
+    if args.incremental:
+        for table_name, file_path in to_process:
+            output_path = os.path.join(output_dir, output_filename(table_name, args.output_format))
+            entry = record_output(plans[table_name][1], output_path, args.output_format)
+            manifest[os.path.basename(file_path)] = {**entry, 'mapped_columns': mapped_columns.get(table_name)}
+        save_manifest(args.mapping_dir, manifest)
     
-    # Second pass: apply mappings
-    for table_name, file_path in csv_files:
-        print(f"\nProcessing {table_name}...")
-        
-        df = read_csv_file(file_path)
-        if df is None:
-            continue
-        
-        mappings = all_mappings.get(table_name, {})
-        if not mappings:
-            print(f"  No mappings for {table_name}, skipping...")
-            continue
-        
-        # Apply mappings for regular ID columns
-        df_new = apply_id_mappings(df, mappings)
-        
-        # Apply cross-table ID mappings
-        cross_table_ids = CROSS_TABLE_IDS.get(table_name, {})
-        for col, (ref_table, ref_col) in cross_table_ids.items():
-            if col in df_new.columns and ref_table in all_mappings and ref_col in all_mappings[ref_table]:
-                ref_mapping = all_mappings[ref_table][ref_col]
-                df_new[col] = df_new[col].map(ref_mapping)
-                # Ensure the column is integer type, not float
-                df_new[col] = pd.to_numeric(df_new[col], errors='coerce').astype('Int64')
-                print(f"  Applied cross-table mapping: {col} -> {ref_table}.{ref_col}")
-        
-        # Save the file
-        save_csv_file(df_new, file_path, output_dir)
+    print("\nPer-table timing (slowest first):")
+    for table_name, (collect, rewrite) in sorted(timings.items(), key=lambda item: sum(item[1]), reverse=True):
+        print(f"  {table_name}: {collect + rewrite:.2f}s (collect {collect:.2f}s, rewrite {rewrite:.2f}s)")
     
     print(f"\nID rewriting completed!")
     print(f"Rewritten files saved to: {output_dir}")
@@ -1,27 +1,1738 @@
-# server.py
-from mcp.server.fastmcp import FastMCP
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterator
+from contextlib import AsyncExitStack, asynccontextmanager
+from dataclasses import dataclass
+from mcp.server.fastmcp import Context, FastMCP
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+from clickhouse_connect.driver.exceptions import OperationalError
+from local_engine import BACKENDS, LocalClient, engine_from_env
+from omop_schema import arrow_type
 import clickhouse_connect
+import pydantic_core
+import anyio
+from array import array
+import numpy as np
+import asyncio
+import base64
+import bisect
+import logging
+import math
 import os
+import re
+import secrets
+import threading
+import time
 
-# Create an MCP server
-mcp = FastMCP("OmopServer")
+logger = logging.getLogger(__name__)
 
-@mcp.tool()
-async def query_omop_database(query: str) -> dict:
-    """Query the OMOP database and return results as a dictionary with column names as keys"""
 
-    client = await clickhouse_connect.get_async_client(
-        host=os.getenv("CLICKHOUSE_HOST", "localhost"), 
-        port=os.getenv("CLICKHOUSE_PORT", 8123),
-        username=os.getenv("CLICKHOUSE_USER", "default"), 
+class ClickHousePool:
+    """Fixed-size pool of long-lived async ClickHouse clients shared by all tool calls.
+
+    Callers queue (FIFO) for a free client for at most ``acquire_timeout`` seconds.
+    Clients idle for longer than ``health_check_interval`` are pinged before being
+    handed out, and clients that failed with a connection error or were abandoned
+    mid-query are closed and transparently reconnected on next use.
+    """
+
+    def __init__(self, size, acquire_timeout, query_timeout, health_check_interval, **client_args):
+        self.size = size
+        self.acquire_timeout = acquire_timeout
+        self.query_timeout = query_timeout
+        self.health_check_interval = health_check_interval
+        self._client_args = client_args
+        self.database = client_args.get("database")
+        # Each slot is (client or None when it must be (re)connected, last time it was used)
+        self._idle = asyncio.Queue()
+        self._closing = set()
+        self._closed = False
+
+    async def open(self):
+        """Fill the pool, connecting eagerly so the first tool calls find warm clients"""
+        for _ in range(self.size):
+            try:
+                client = await self._connect()
+            except Exception as e:
+                logger.warning("Could not connect to ClickHouse, will retry on first use: %s", e)
+                client = None
+            self._idle.put_nowait((client, time.monotonic()))
+
+    async def close(self):
+        """Close idle clients and wait for abandoned ones to finish closing"""
+        self._closed = True
+        while not self._idle.empty():
+            client, _ = self._idle.get_nowait()
+            if client is not None:
+                await client.close()
+        if self._closing:
+            await asyncio.gather(*self._closing, return_exceptions=True)
+
+    async def _connect(self):
+        # A pooled client runs one query at a time, so it only needs a couple of executor threads
+        return await clickhouse_connect.get_async_client(executor_threads=2, **self._client_args)
+
+    async def _acquire(self):
+        if self._closed:
+            raise RuntimeError("ClickHouse pool is closed")
+        try:
+            client, last_used = await asyncio.wait_for(self._idle.get(), self.acquire_timeout)
+        except TimeoutError:
+            raise TimeoutError(
+                f"No ClickHouse connection available after {self.acquire_timeout}s "
+                f"({self.size} connections busy)"
+            ) from None
+        try:
+            if client is not None and time.monotonic() - last_used > self.health_check_interval:
+                if not await client.ping():
+                    logger.info("Pooled ClickHouse client failed health check, reconnecting")
+                    self._discard(client)
+                    client = None
+            if client is None:
+                client = await self._connect()
+        except BaseException:
+            self._idle.put_nowait((None, time.monotonic()))
+            raise
+        return client
+
+    def _discard(self, client):
+        task = asyncio.create_task(client.close())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    @asynccontextmanager
+    async def connection(self):
+        """Lease a client for the duration of the block"""
+        client = await self._acquire()
+        healthy = True
+        try:
+            yield client
+        except (OperationalError, TimeoutError, asyncio.CancelledError):
+            # Either the connection is broken or a worker thread may still be using the client
+            healthy = False
+            raise
+        finally:
+            if not healthy or self._closed:
+                self._discard(client)
+                client = None
+            self._idle.put_nowait((client, time.monotonic()))
+
+
+class LocalEnginePool(ClickHousePool):
+    """Pool handing out clients of an embedded chDB engine instead of server connections.
+
+    The engine runs one statement at a time, so here the pool size only bounds how many
+    queries and open cursors can hold a client while waiting for it.
+    """
+
+    def __init__(self, size, acquire_timeout, query_timeout, engine):
+        super().__init__(size, acquire_timeout, query_timeout, math.inf, database=engine.database)
+        self.engine = engine
+
+    async def open(self):
+        """Open the engine, loading the tables whose files changed, then fill the pool"""
+        await asyncio.to_thread(self.engine.open)
+        await super().open()
+
+    async def close(self):
+        await super().close()
+        await asyncio.to_thread(self.engine.close)
+
+    async def _connect(self):
+        return LocalClient(self.engine)
+
+
+# Pooled clients taken outside admission control: the two concept index loads, the cache
+# generation check and the schema cache
+BACKGROUND_CONNECTIONS = 4
+
+
+def _connection_budget():
+    """Return (pool size, max running queries, max open cursors).
+
+    Open cursors and background loads hold pooled clients without an admission slot, so the pool
+    keeps room for them on top of the queries admitted to run.
+    """
+    max_open = int(os.getenv("OMOP_MAX_OPEN_CURSORS", 2))
+    max_running = int(os.getenv("OMOP_MAX_RUNNING_QUERIES", 4))
+    size = int(os.getenv("CLICKHOUSE_POOL_SIZE", max_running + max_open + BACKGROUND_CONNECTIONS))
+    available = size - max_open - BACKGROUND_CONNECTIONS
+    if max_running > available:
+        logger.warning(
+            "A pool of %d clients leaves room for %d running queries next to %d open cursors and %d "
+            "background loads, lowering OMOP_MAX_RUNNING_QUERIES from %d",
+            size, max(1, available), max_open, BACKGROUND_CONNECTIONS, max_running,
+        )
+        max_running = max(1, available)
+    return size, max_running, max_open
+
+
+def _create_pool(size):
+    """Pool of the backend selected by OMOP_BACKEND: a ClickHouse server or the embedded chDB engine"""
+    backend = os.getenv("OMOP_BACKEND", "clickhouse")
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown OMOP_BACKEND {backend!r}, expected one of {BACKENDS}")
+    acquire_timeout = float(os.getenv("CLICKHOUSE_POOL_TIMEOUT", 30))
+    query_timeout = float(os.getenv("CLICKHOUSE_QUERY_TIMEOUT", 300))
+    if backend == "chdb":
+        return LocalEnginePool(size, acquire_timeout, query_timeout, engine_from_env())
+    return ClickHousePool(
+        size=size,
+        acquire_timeout=acquire_timeout,
+        query_timeout=query_timeout,
+        health_check_interval=float(os.getenv("CLICKHOUSE_HEALTH_CHECK_INTERVAL", 30)),
+        host=os.getenv("CLICKHOUSE_HOST", "localhost"),
+        port=int(os.getenv("CLICKHOUSE_PORT", 8123)),
+        username=os.getenv("CLICKHOUSE_USER", "default"),
         password=os.getenv("CLICKHOUSE_PASSWORD", "default"),
-        database=os.getenv("CLICKHOUSE_DB", "omop")
+        database=os.getenv("CLICKHOUSE_DB", "omop"),
+    )
+
+
+def _value_size(value):
+    """Rough serialized size of a result value, used to bound page sizes"""
+    if isinstance(value, (str, bytes)):
+        return len(value) + 2
+    return 8
+
+
+class QueryCursor:
+    """Server-side stream over a query result, read one page at a time.
+
+    The cursor holds a pooled client and an open column block stream until the
+    result is exhausted or the cursor is closed, so only the current block and
+    page are ever held in memory.
+    """
+
+    def __init__(self, pool, query, block_size, settings=None, row_limit=None):
+        self.pool = pool
+        self.query = query
+        self.block_size = block_size
+        self.settings = settings or {}
+        self.row_limit = row_limit
+        self.column_names = ()
+        self.column_types = ()
+        self.rows_returned = 0
+        self.truncated_reason = None
+        self.query_id = None
+        self.summary = {}
+        self.exhausted = False
+        self.last_used = time.monotonic()
+        self.lock = asyncio.Lock()
+        self._stack = AsyncExitStack()
+        self._stream = None
+        self._block = None
+        self._offset = 0
+
+    async def open(self):
+        try:
+            client = await self._stack.enter_async_context(self.pool.connection())
+            async with asyncio.timeout(self.pool.query_timeout):
+                stream = await client.query_column_block_stream(
+                    self.query, settings={**self.settings, "max_block_size": self.block_size}
+                )
+            self._stream = self._stack.enter_context(stream)
+            self.column_names = tuple(stream.source.column_names)
+            self.column_types = tuple(t.name for t in stream.source.column_types)
+            # Progress counters as of the response headers, sent when the first block is ready
+            self.query_id = stream.source.query_id
+            self.summary = stream.source.summary
+        except BaseException as e:
+            await self.close(e)
+            raise
+
+    async def close(self, error=None):
+        self.exhausted = True
+        if error is None:
+            await self._stack.aclose()
+        else:
+            await self._stack.__aexit__(type(error), error, error.__traceback__)
+
+    def _block_rows(self):
+        return len(self._block[0]) if self._block else 0
+
+    async def _next_block(self):
+        self._block = await asyncio.to_thread(next, self._stream, None)
+        self._offset = 0
+        if self._block is None:
+            await self.close()
+
+    async def fetch(self, max_rows, max_bytes):
+        """Read up to ``max_rows`` rows / ``max_bytes`` estimated bytes as a list of columns"""
+        self.last_used = time.monotonic()
+        if self.row_limit is not None:
+            max_rows = min(max_rows, self.row_limit - self.rows_returned)
+        columns = [[] for _ in self.column_names]
+        rows = size = 0
+        try:
+            async with asyncio.timeout(self.pool.query_timeout):
+                while not self.exhausted and rows < max_rows and size < max_bytes:
+                    if self._offset >= self._block_rows():
+                        await self._next_block()
+                        continue
+                    start = end = self._offset
+                    stop = min(self._block_rows(), start + max_rows - rows)
+                    # Always take at least one row so a single huge row cannot stall the cursor
+                    while end < stop and (end == start or size < max_bytes):
+                        size += sum(_value_size(column[end]) for column in self._block)
+                        end += 1
+                    for page_column, block_column in zip(columns, self._block):
+                        page_column.extend(block_column[start:end])
+                    rows += end - start
+                    self._offset = end
+                # Peek ahead so callers know whether another page exists
+                if not self.exhausted and self._offset >= self._block_rows():
+                    await self._next_block()
+            self.rows_returned += rows
+            if not self.exhausted and self.row_limit is not None and self.rows_returned >= self.row_limit:
+                self.truncated_reason = (
+                    f"Result limited to {self.row_limit} rows by the default LIMIT added by the server; "
+                    "add an explicit LIMIT, filter or aggregate to see more"
+                )
+                await self.close()
+            elif self.exhausted and self.rows_returned >= self.settings.get("max_result_rows", 0) > 0 \
+                    and self.settings.get("result_overflow_mode") == "break":
+                self.truncated_reason = (
+                    f"Result cut at the server max_result_rows setting ({self.settings['max_result_rows']} rows)"
+                )
+        except BaseException as e:
+            await self.close(e)
+            raise
+        return columns
+
+
+class CursorRegistry:
+    """Open query cursors addressable by an opaque continuation token.
+
+    Every cursor pins a pooled client outside admission control, so the number of open
+    cursors is capped (evicting the least recently used one), the pool keeps room for them,
+    and idle cursors expire after ``ttl``.
+    """
+
+    def __init__(self, pool, guard, max_open, ttl, page_rows, page_bytes):
+        self.pool = pool
+        self.guard = guard
+        self.max_open = max_open
+        self.ttl = ttl
+        self.page_rows = page_rows
+        self.page_bytes = page_bytes
+        self._cursors = {}
+
+    async def _expire(self):
+        now = time.monotonic()
+        for token, cursor in list(self._cursors.items()):
+            if now - cursor.last_used > self.ttl and not cursor.lock.locked():
+                await self.discard(token)
+
+    async def discard(self, token):
+        cursor = self._cursors.pop(token, None)
+        if cursor is not None:
+            # Waits for a page being fetched, rather than closing the stream under it
+            async with cursor.lock:
+                await cursor.close()
+
+    async def close(self):
+        for token in list(self._cursors):
+            await self.discard(token)
+
+    def limits(self, page_size):
+        rows = self.page_rows if page_size is None else max(1, min(page_size, self.page_rows))
+        return rows, self.page_bytes
+
+    async def execute(self, query, page_size=None):
+        """Run a query and return its first page, registering a cursor if more rows remain"""
+        await self._expire()
+        max_rows, max_bytes = self.limits(page_size)
+        query, row_limit = self.guard.prepare(query)
+        cursor = QueryCursor(
+            self.pool, query, block_size=max_rows, settings=self.guard.settings, row_limit=row_limit
+        )
+        await cursor.open()
+        columns = await cursor.fetch(max_rows, max_bytes)
+        token = None
+        if not cursor.exhausted:
+            while len(self._cursors) >= self.max_open:
+                oldest = min(self._cursors, key=lambda t: self._cursors[t].last_used)
+                logger.info("Evicting least recently used cursor %s", oldest)
+                await self.discard(oldest)
+            token = secrets.token_urlsafe(16)
+            self._cursors[token] = cursor
+        return cursor, columns, token
+
+    async def fetch(self, token, page_size=None):
+        """Return the next page of an open cursor"""
+        await self._expire()
+        cursor = self._cursors.get(token)
+        if cursor is None:
+            raise ValueError("Unknown or expired cursor, re-run the query")
+        max_rows, max_bytes = self.limits(page_size)
+        async with cursor.lock:
+            if self._cursors.get(token) is not cursor:
+                raise ValueError("Unknown or expired cursor, re-run the query")
+            try:
+                columns = await cursor.fetch(max_rows, max_bytes)
+            finally:
+                if cursor.exhausted:
+                    self._cursors.pop(token, None)
+        return cursor, columns, None if cursor.exhausted else token
+
+
+RESULT_FORMATS = ("rows", "columns", "arrow")
+
+
+def _check_format(result_format):
+    if result_format not in RESULT_FORMATS:
+        raise ValueError(f"Unknown result format {result_format!r}, expected one of {RESULT_FORMATS}")
+    if result_format == "arrow":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ValueError("The 'arrow' result format requires pyarrow (pip install pyarrow)") from None
+
+
+def _arrow_ipc(column_names, column_types, columns):
+    """Encode a page of columns as a base64 Arrow IPC stream, typed after the ClickHouse column types"""
+    import pyarrow as pa
+
+    arrays = []
+    for column_type, values in zip(column_types, columns):
+        try:
+            arrays.append(pa.array(values, type=arrow_type(column_type)))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # Types without an Arrow counterpart here (UUID, Map, Array, ...) are sent as text
+            arrays.append(pa.array([None if value is None else str(value) for value in values], type=pa.string()))
+    # From arrays rather than a dict, so duplicate column names of joins are kept
+    table = pa.Table.from_arrays(arrays, names=list(column_names))
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return base64.b64encode(sink.getvalue().to_pybytes()).decode()
+
+
+def _page(cursor, columns, token, result_format="rows"):
+    """Build the tool response for one page of results as compact JSON.
+
+    ``rows`` returns one object per row, ``columns`` returns the column names once
+    followed by one array per column, and ``arrow`` returns a base64 Arrow IPC stream.
+    """
+    page = {"columns": list(cursor.column_names)}
+    if result_format == "rows":
+        page["rows"] = [dict(zip(cursor.column_names, row)) for row in zip(*columns)]
+    elif result_format == "columns":
+        page["types"] = list(cursor.column_types)
+        page["data"] = columns
+    else:
+        page["arrow_ipc_base64"] = _arrow_ipc(cursor.column_names, cursor.column_types, columns)
+    page["row_count"] = len(columns[0]) if columns else 0
+    page["has_more"] = token is not None
+    page["cursor"] = token
+    page["truncated"] = cursor.truncated_reason is not None
+    page["truncated_reason"] = cursor.truncated_reason
+    return pydantic_core.to_json(page, fallback=str).decode()
+
+
+_SQL_LEXEME = re.compile(
+    r"""
+    (?P<literal>'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*"|`(?:[^`\\]|\\.)*`)
+    | (?P<comment>--[^\n]*|/\*.*?\*/)
+    | (?P<space>\s+)
+    | (?P<other>[^'"`\s/();-]+|.)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+_CACHEABLE_STATEMENTS = ("SELECT", "WITH", "SHOW", "DESCRIBE", "DESC", "EXISTS", "EXPLAIN")
+
+# Functions whose result changes between calls, so queries using them are never cached
+_NONDETERMINISTIC = re.compile(
+    r"\b(now|now64|today|yesterday|rand\w*|generateUUID\w*|currentUser|uptime|hostName)\s*\(",
+    re.IGNORECASE,
+)
+
+
+_METADATA_STATEMENTS = ("SHOW", "DESCRIBE", "DESC", "EXISTS", "EXPLAIN")
+
+
+def query_priority(query):
+    """Admission priority of a query: ``light`` for metadata statements and queries
+    reading only system tables (or no table at all), ``heavy`` for anything else"""
+    tokens = [m.group() for m in _SQL_LEXEME.finditer(query) if m.lastgroup in ("literal", "other")]
+    if not tokens or tokens[0].upper() in _METADATA_STATEMENTS:
+        return "light"
+    sources = [
+        tokens[i + 1].strip('`"').lower()
+        for i, token in enumerate(tokens[:-1])
+        if token.upper() in ("FROM", "JOIN") and tokens[i + 1] != "("
+    ]
+    if all(source.startswith(("system.", "information_schema.")) for source in sources):
+        return "light"
+    return "heavy"
+
+
+def normalize_sql(query):
+    """Collapse whitespace and comments outside literals and drop trailing semicolons"""
+    parts = []
+    for match in _SQL_LEXEME.finditer(query):
+        if match.lastgroup in ("comment", "space"):
+            if parts and parts[-1] != " ":
+                parts.append(" ")
+        else:
+            parts.append(match.group())
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+def _top_level_tokens(query):
+    """Return (offset, token) for the tokens outside comments and parentheses, words upper-cased
+    and each literal or parenthesized group as a single token (its opening quote or parenthesis),
+    plus the offset just past the last code lexeme (before trailing comments and semicolons)"""
+    tokens = []
+    depth = 0
+    end = 0
+    for match in _SQL_LEXEME.finditer(query):
+        if match.lastgroup in ("comment", "space"):
+            continue
+        text = match.group()
+        if text != ";":
+            end = match.end()
+        if text == "(":
+            if depth == 0:
+                tokens.append((match.start(), text))
+            depth += 1
+        elif text == ")":
+            depth -= 1
+        elif depth == 0 and match.lastgroup == "literal":
+            tokens.append((match.start(), text[0]))
+        elif depth == 0:
+            tokens.extend(
+                (match.start() + token.start(), token.group().upper()) for token in re.finditer(r"\w+|\S", text)
+            )
+    return tokens, end
+
+
+# Clause keywords a row limit is checked for or must be placed before
+_CLAUSES = ("LIMIT", "FETCH", "SETTINGS", "FORMAT", "INTO", "UNION", "INTERSECT", "EXCEPT")
+
+# Words after which an expression or name is expected, so a clause keyword there is an identifier
+_BEFORE_OPERAND = {
+    "SELECT", "DISTINCT", "ALL", "FROM", "JOIN", "WHERE", "PREWHERE", "HAVING", "ON", "USING", "AND",
+    "OR", "NOT", "AS", "BY", "WITH", "CASE", "WHEN", "THEN", "ELSE", "IN", "IS", "LIKE", "ILIKE",
+    "BETWEEN", "INTERVAL", "ARRAY", "OFFSET", "TOP", *_CLAUSES,
+}
+
+# Words that only follow an expression or name, so a clause keyword before them is an identifier
+_AFTER_OPERAND = {
+    "FROM", "AS", "AND", "OR", "WHERE", "PREWHERE", "GROUP", "ORDER", "HAVING", "WINDOW", "QUALIFY",
+    "JOIN", "ON", "USING", "IN", "IS", "LIKE", "ILIKE", "BETWEEN", "ASC", "DESC", "BY", "THEN",
+    "ELSE", "END", "OFFSET", *_CLAUSES,
+}
+
+
+def _starts_clause(tokens, i):
+    """Whether the top-level token ``i`` starts a clause, rather than being a column, alias or
+    function named like one (``SELECT format FROM t``, ``t.limit``, ``format(...)``): it must
+    follow a complete expression and be followed by the start of the clause's argument"""
+    word = tokens[i][1]
+    if word not in _CLAUSES or i == 0 or i + 1 == len(tokens):
+        return False
+    before, after = tokens[i - 1][1], tokens[i + 1][1]
+    if before in _BEFORE_OPERAND or not (before[0].isalnum() or before[0] in "_'\"`(])}"):
+        return False
+    if after in _AFTER_OPERAND:
+        return False
+    if after == "(":
+        # format(...) and the like, while LIMIT and set operations may take a parenthesized operand
+        return word in ("LIMIT", "UNION", "INTERSECT", "EXCEPT")
+    return after[0].isalnum() or after[0] in "_'\"`{"
+
+
+def add_default_limit(query, limit):
+    """Append ``LIMIT limit`` to a SELECT without a top-level row limit.
+
+    Returns None when the query is not a SELECT or already limits its rows.
+    ``LIMIT n BY`` clauses do not count as a row limit, and neither does the
+    ``LIMIT`` of the last SELECT of a UNION, which applies to that SELECT only.
+    """
+    tokens, end = _top_level_tokens(query)
+    if not tokens or tokens[0][1] not in ("SELECT", "WITH"):
+        return None
+    clauses = [i for i in range(len(tokens)) if _starts_clause(tokens, i)]
+    set_operation = any(tokens[i][1] in ("UNION", "INTERSECT", "EXCEPT") for i in clauses)
+    for i, stop in zip(clauses, clauses[1:] + [len(tokens)]):
+        word = tokens[i][1]
+        limit_by = "BY" in (token for _, token in tokens[i + 1:stop])
+        if not set_operation and (word == "FETCH" or (word == "LIMIT" and not limit_by)):
+            return None
+    # The limit must precede trailing SETTINGS / FORMAT / INTO OUTFILE clauses
+    tail = next((tokens[i][0] for i in clauses if tokens[i][1] in ("SETTINGS", "FORMAT", "INTO")), end)
+    body, rest = query[:tail].rstrip(), query[tail:end]
+    if set_operation:
+        # A trailing LIMIT would only apply to the last SELECT of the set operation
+        return f"SELECT * FROM ({body}) LIMIT {limit} {rest}".rstrip()
+    return f"{body} LIMIT {limit} {rest}".rstrip()
+
+
+class QueryGuard:
+    """Constrains LLM-generated SQL before it reaches the shared ClickHouse cluster.
+
+    SELECTs without a row limit get ``LIMIT default_limit + 1`` so the cursor can
+    report whether rows were cut, and every query runs with the resource settings
+    (``max_execution_time``, ``max_result_rows``, ``max_memory_usage``, ``max_threads``...).
+    """
+
+    def __init__(self, default_limit, settings):
+        self.default_limit = default_limit
+        self.settings = {name: value for name, value in settings.items() if value}
+
+    def prepare(self, query):
+        """Return the query to run and the row limit to enforce, if the server added one"""
+        if self.default_limit > 0:
+            limited = add_default_limit(query, self.default_limit + 1)
+            if limited is not None:
+                return limited, self.default_limit
+        return query, None
+
+
+class QueryCache:
+    """LRU cache of serialized single-page query responses.
+
+    Entries expire after ``ttl`` seconds and the cache is bounded by both entry
+    count and total bytes. The whole cache is dropped when the data generation
+    marker (derived from the active parts of the database) changes, i.e. after
+    any data load.
+    """
+
+    GENERATION_QUERY = """
+        SELECT sum(rows), sum(max_block)
+        FROM (
+            SELECT table, sum(rows) AS rows, max(max_block_number) AS max_block
+            FROM system.parts
+            WHERE active AND database = currentDatabase()
+            GROUP BY table
+        )
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl, generation_check_interval):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.generation_check_interval = generation_check_interval
+        self.generation = None
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._generation_checked = float("-inf")
+        self._generation_lock = asyncio.Lock()
+
+    def key(self, database, query, *options):
+        """Cache key for a query, or None when the query must not be cached"""
+        if self.max_entries <= 0:
+            return None
+        sql = normalize_sql(query)
+        statement = re.match(r"\w*", sql).group().upper()
+        if statement not in _CACHEABLE_STATEMENTS or _NONDETERMINISTIC.search(sql):
+            return None
+        return (database, sql, *options)
+
+    async def check_generation(self, pool):
+        """Invalidate the cache if the data changed since the last check"""
+        if time.monotonic() - self._generation_checked < self.generation_check_interval:
+            return
+        async with self._generation_lock:
+            if time.monotonic() - self._generation_checked < self.generation_check_interval:
+                return
+            async with pool.connection() as client:
+                async with asyncio.timeout(pool.query_timeout):
+                    result = await client.query(self.GENERATION_QUERY)
+            generation = tuple(result.result_rows[0]) if result.result_rows else ()
+            if generation != self.generation:
+                if self.generation is not None:
+                    logger.info("Data generation changed, invalidating query cache")
+                    self.invalidations += 1
+                self.clear()
+                self.generation = generation
+            self._generation_checked = time.monotonic()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] < time.monotonic():
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._bytes += len(value)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        value, _ = self._entries.pop(key)
+        self._bytes -= len(value)
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "generation": list(self.generation) if self.generation is not None else None,
+        }
+
+
+def _percentiles(values, percentiles):
+    """Nearest-rank percentiles of a sample, None when it is empty"""
+    values = sorted(values)
+    if not values:
+        return {f"p{p}": None for p in percentiles}
+    return {f"p{p}": values[max(0, math.ceil(p / 100 * len(values)) - 1)] for p in percentiles}
+
+
+class QueryMetrics:
+    """Latency and resource usage of ``query_omop_database`` calls.
+
+    Wall times of the last ``window`` calls give the latency percentiles; rows and
+    bytes read by ClickHouse, result sizes and serialization time are summed since
+    startup. Calls slower than ``slow_seconds`` are logged with their SQL to the
+    ``omop.slow_queries`` logger, and the last ``slow_log_size`` of them are kept.
+    """
+
+    PERCENTILES = (50, 90, 95, 99)
+    COUNTERS = (
+        "calls", "errors", "cache_hits", "slow_queries", "seconds", "queue_seconds", "serialize_seconds",
+        "read_rows", "read_bytes", "result_rows", "result_bytes",
+    )
+
+    def __init__(self, window, slow_seconds, slow_log_size):
+        self.slow_seconds = slow_seconds
+        self.totals = dict.fromkeys(self.COUNTERS, 0)
+        self.slow_log = deque(maxlen=slow_log_size)
+        self._latencies = deque(maxlen=window)
+        self._slow_logger = logging.getLogger("omop.slow_queries")
+
+    @asynccontextmanager
+    async def measure(self, query):
+        """Time the block and record the sample it fills in, even when it fails"""
+        sample = {
+            "query_id": None, "cached": False, "priority": None, "queue_seconds": 0.0, "read_rows": 0,
+            "read_bytes": 0, "result_rows": 0, "result_bytes": 0, "serialize_seconds": 0.0, "error": None,
+        }
+        start = time.perf_counter()
+        try:
+            yield sample
+        except BaseException as e:
+            sample["error"] = type(e).__name__
+            raise
+        finally:
+            sample["seconds"] = time.perf_counter() - start
+            self.record(query, sample)
+
+    def reset(self):
+        """Forget the calls recorded so far"""
+        self.totals = dict.fromkeys(self.COUNTERS, 0)
+        self.slow_log.clear()
+        self._latencies.clear()
+
+    def record(self, query, sample):
+        self._latencies.append(sample["seconds"])
+        totals = self.totals
+        totals["calls"] += 1
+        totals["errors"] += sample["error"] is not None
+        totals["cache_hits"] += sample["cached"]
+        for name in ("seconds", "queue_seconds", "serialize_seconds", "read_rows", "read_bytes", "result_rows", "result_bytes"):
+            totals[name] += sample[name]
+        if sample["seconds"] >= self.slow_seconds:
+            totals["slow_queries"] += 1
+            entry = {"time": time.time(), **sample, "query": query}
+            self.slow_log.append(entry)
+            self._slow_logger.warning("Slow query (%.3fs): %s", sample["seconds"], _to_json(entry))
+
+    def percentiles(self):
+        """Nearest-rank latency percentiles in seconds over the recent window"""
+        return _percentiles(self._latencies, self.PERCENTILES)
+
+    def stats(self):
+        return {
+            **self.totals,
+            "window": len(self._latencies),
+            "latency_seconds": self.percentiles(),
+            "slow_query_seconds": self.slow_seconds,
+            "slow_log": list(self.slow_log),
+        }
+
+    def prometheus(self):
+        """Metrics in the Prometheus text exposition format"""
+        lines = [
+            "# HELP omop_query_duration_seconds Wall time of query_omop_database calls over the recent window",
+            "# TYPE omop_query_duration_seconds summary",
+        ]
+        for name, value in self.percentiles().items():
+            if value is not None:
+                lines.append(f'omop_query_duration_seconds{{quantile="{int(name[1:]) / 100}"}} {value}')
+        lines.append(f"omop_query_duration_seconds_sum {self.totals['seconds']}")
+        lines.append(f"omop_query_duration_seconds_count {self.totals['calls']}")
+        for name in self.COUNTERS:
+            if name not in ("calls", "seconds"):
+                metric = f"omop_query_{name}_total"
+                lines += [f"# TYPE {metric} counter", f"{metric} {self.totals[name]}"]
+        return "\n".join(lines) + "\n"
+
+
+class AdmissionRejected(RuntimeError):
+    pass
+
+
+class AdmissionControl:
+    """Bounds the queries running at once, globally and per MCP session.
+
+    Calls over the limits wait in a bounded queue for at most ``queue_timeout``
+    seconds. Freed slots go to the oldest waiter of the highest priority whose
+    session is under its own limit, so cheap metadata and concept lookups
+    (``light``) overtake table scans (``heavy``), and one agent firing many
+    parallel queries cannot starve the others.
+    """
+
+    PRIORITIES = ("light", "heavy")
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, max_running, max_per_session, max_queued, queue_timeout, window=10000):
+        self.max_running = max_running
+        self.max_per_session = max_per_session
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self.admitted = dict.fromkeys(self.PRIORITIES, 0)
+        self.rejected = dict.fromkeys(self.PRIORITIES, 0)
+        self.timeouts = dict.fromkeys(self.PRIORITIES, 0)
+        self.wait_seconds = dict.fromkeys(self.PRIORITIES, 0.0)
+        self._waits = {priority: deque(maxlen=window) for priority in self.PRIORITIES}
+        self._sessions = {}
+        # Each waiter is (session, future resolved when it is granted a slot)
+        self._queues = {priority: deque() for priority in self.PRIORITIES}
+
+    def queued(self, priority=None):
+        if priority is None:
+            return sum(len(queue) for queue in self._queues.values())
+        return len(self._queues[priority])
+
+    @asynccontextmanager
+    async def slot(self, session, priority="heavy"):
+        """Hold an execution slot for the duration of the block, yield the seconds waited for it"""
+        waited = await self._acquire(session, priority)
+        try:
+            yield waited
+        finally:
+            self._release(session)
+
+    async def _acquire(self, session, priority):
+        start = time.perf_counter()
+        waiter = (session, asyncio.get_running_loop().create_future())
+        queue = self._queues[priority]
+        queue.append(waiter)
+        self._dispatch()
+        if not waiter[1].done() and self.queued() > self.max_queued:
+            queue.remove(waiter)
+            self.rejected[priority] += 1
+            raise AdmissionRejected(
+                f"Server busy: {self.running} queries running and {self.max_queued} queued, retry later"
+            )
+        try:
+            async with asyncio.timeout(self.queue_timeout):
+                await waiter[1]
+        except BaseException as e:
+            if waiter[1].done() and not waiter[1].cancelled():
+                # Granted just as the wait was given up, hand the slot on
+                self._release(session)
+            else:
+                waiter[1].cancel()
+                queue.remove(waiter)
+            if isinstance(e, TimeoutError):
+                self.timeouts[priority] += 1
+                raise TimeoutError(
+                    f"No query slot available after {self.queue_timeout}s "
+                    f"({self.running} queries running, {self.queued()} queued)"
+                ) from None
+            raise
+        waited = time.perf_counter() - start
+        self.admitted[priority] += 1
+        self.wait_seconds[priority] += waited
+        self._waits[priority].append(waited)
+        return waited
+
+    def _release(self, session):
+        self.running -= 1
+        self._sessions[session] -= 1
+        if not self._sessions[session]:
+            del self._sessions[session]
+        self._dispatch()
+
+    def _dispatch(self):
+        """Grant free slots to waiters in priority order, skipping sessions at their limit"""
+        for priority in self.PRIORITIES:
+            queue = self._queues[priority]
+            for waiter in list(queue):
+                if self.running >= self.max_running:
+                    return
+                session, future = waiter
+                if self._sessions.get(session, 0) >= self.max_per_session:
+                    continue
+                queue.remove(waiter)
+                self.running += 1
+                self._sessions[session] = self._sessions.get(session, 0) + 1
+                future.set_result(None)
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "sessions": len(self._sessions),
+            "max_running": self.max_running,
+            "max_per_session": self.max_per_session,
+            "max_queued": self.max_queued,
+            "queue_timeout": self.queue_timeout,
+            "queued": {priority: self.queued(priority) for priority in self.PRIORITIES},
+            "admitted": dict(self.admitted),
+            "rejected": dict(self.rejected),
+            "timeouts": dict(self.timeouts),
+            "wait_seconds": {
+                priority: _percentiles(self._waits[priority], self.PERCENTILES) for priority in self.PRIORITIES
+            },
+        }
+
+    def prometheus(self):
+        """Metrics in the Prometheus text exposition format"""
+        lines = [
+            "# TYPE omop_admission_running gauge",
+            f"omop_admission_running {self.running}",
+            "# TYPE omop_admission_queue_depth gauge",
+        ]
+        lines += [f'omop_admission_queue_depth{{priority="{p}"}} {self.queued(p)}' for p in self.PRIORITIES]
+        for name, counts in (("admitted", self.admitted), ("rejected", self.rejected), ("timeouts", self.timeouts)):
+            lines.append(f"# TYPE omop_admission_{name}_total counter")
+            lines += [f'omop_admission_{name}_total{{priority="{p}"}} {counts[p]}' for p in self.PRIORITIES]
+        lines.append("# TYPE omop_admission_wait_seconds summary")
+        for priority in self.PRIORITIES:
+            for name, value in _percentiles(self._waits[priority], self.PERCENTILES).items():
+                if value is not None:
+                    lines.append(
+                        f'omop_admission_wait_seconds{{priority="{priority}",quantile="{int(name[1:]) / 100}"}} {value}'
+                    )
+            lines.append(f'omop_admission_wait_seconds_sum{{priority="{priority}"}} {self.wait_seconds[priority]}')
+            lines.append(f'omop_admission_wait_seconds_count{{priority="{priority}"}} {self.admitted[priority]}')
+        return "\n".join(lines) + "\n"
+
+
+def _sql_string(value):
+    """Quote a string as a ClickHouse literal"""
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+async def _stream_blocks(pool, query, block_size=65536):
+    """Yield the column blocks of a query result, holding one pooled client meanwhile"""
+    async with pool.connection() as client:
+        stream = await client.query_column_block_stream(query, settings={"max_block_size": block_size})
+        with stream:
+            while (block := await asyncio.to_thread(next, stream, None)) is not None:
+                yield block
+
+
+class IndexBudgetExceeded(Exception):
+    pass
+
+
+class ConceptIndex:
+    """In-memory concept search and hierarchy index over the vocabulary tables.
+
+    Concept names and synonyms are split into lowercase tokens kept in a sorted
+    list, with the concepts of each token in CSR posting arrays, so a prefix search
+    is a bisect plus a contiguous slice. ``concept_ancestor`` is held as a CSR
+    adjacency array keyed by ancestor. Each part is loaded once on first use (or
+    in the background at startup); a part that would take the memory used by the
+    index above ``max_bytes`` is dropped and the tools fall back to SQL.
+    """
+
+    TOKEN = re.compile(r"\w+")
+    # Shorter query terms only match whole tokens, to avoid unioning huge posting ranges
+    MIN_PREFIX = 3
+    CONCEPT_COLUMNS = (
+        "concept_id", "concept_name", "domain_id", "vocabulary_id",
+        "concept_class_id", "standard_concept", "concept_code",
     )
-    
-    result = await client.query(query)
-    # Create a list of dictionaries where each dictionary represents a row
-    # with column names as keys
-    return [dict(zip(result.column_names, row)) for row in result.result_rows]
+
+    RETRY_INTERVAL = 60
+
+    def __init__(self, pool, max_bytes):
+        self.pool = pool
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        # Bytes reserved by each part; both parts load concurrently from worker threads
+        self._reserved = {}
+        self._budget_lock = threading.Lock()
+        self.unavailable = {}
+        self._tasks = {}
+        self._failed_at = {}
+        # Search part
+        self.ids = None
+        self.names = None
+        self.codes = None
+        self.categories = None
+        self.category_values = None
+        self.name_lengths = None
+        self.tokens = None
+        self.token_offsets = None
+        self.postings = None
+        # Hierarchy part
+        self.ancestors = None
+        self.descendant_offsets = None
+        self.descendants = None
+        self.levels = None
+
+    def preload(self):
+        for part in ("search", "hierarchy"):
+            self._start(part)
+
+    async def close(self):
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks.clear()
+
+    def _start(self, part):
+        if part in self._tasks or part in self.unavailable:
+            return
+        if time.monotonic() - self._failed_at.get(part, -self.RETRY_INTERVAL) < self.RETRY_INTERVAL:
+            return
+        loader = self._load_search if part == "search" else self._load_hierarchy
+        task = self._tasks[part] = asyncio.create_task(loader())
+        task.add_done_callback(lambda task: self._loaded(part, task))
+
+    def _loaded(self, part, task):
+        if task.cancelled():
+            self._tasks.pop(part, None)
+            return
+        error = task.exception()
+        if isinstance(error, IndexBudgetExceeded):
+            self.unavailable[part] = str(error)
+            logger.warning("Concept %s index disabled: %s", part, error)
+        elif error is not None:
+            # Retried later, e.g. once the database is reachable
+            self._tasks.pop(part, None)
+            self._failed_at[part] = time.monotonic()
+            logger.error("Loading the concept %s index failed", part, exc_info=error)
+
+    def ready(self, part):
+        """Whether a part is loaded, starting to load it in the background if needed"""
+        self._start(part)
+        task = self._tasks.get(part)
+        return task is not None and task.done() and not task.cancelled() and task.exception() is None
+
+    def _reserve(self, nbytes, part):
+        with self._budget_lock:
+            if self.nbytes + nbytes > self.max_bytes:
+                raise IndexBudgetExceeded(
+                    f"the {part} index needs more than OMOP_CONCEPT_INDEX_MAX_BYTES={self.max_bytes}"
+                )
+            self._reserved[part] = self._reserved.get(part, 0) + nbytes
+            self.nbytes += nbytes
+
+    def _settle(self, part, nbytes):
+        """Replace the reservation of a part by the bytes it actually holds, 0 to release it"""
+        with self._budget_lock:
+            self.nbytes += nbytes - self._reserved.get(part, 0)
+            self._reserved[part] = nbytes
+
+    async def _load_search(self):
+        try:
+            index = await self._build_search()
+        except BaseException:
+            self._settle("search", 0)
+            raise
+        (self.ids, self.names, self.codes, self.categories, self.category_values,
+         self.name_lengths, self.tokens, self.token_offsets, self.postings) = index
+        logger.info("Loaded %d concepts and %d search tokens", len(self.ids), len(self.tokens))
+
+    async def _build_search(self):
+        ids, names, codes = [], [], []
+        categories = [[] for _ in range(4)]
+        category_values = [{} for _ in range(4)]
+        token_ids = {}
+        # (token id << 32 | row) for every token of every concept name and synonym
+        pairs = array("q")
+
+        def add_tokens(row, text):
+            found = set(self.TOKEN.findall(text.lower()))
+            self._reserve(8 * len(found), "search")
+            for token in found:
+                token_id = token_ids.get(token)
+                if token_id is None:
+                    token_id = token_ids[token] = len(token_ids)
+                    self._reserve(len(token) + 80, "search")
+                pairs.append(token_id << 32 | row)
+
+        def add_concepts(block):
+            concept_id, name, domain, vocabulary, concept_class, standard, code = block
+            start = len(ids)
+            self._reserve(sum(len(n) + len(c) for n, c in zip(name, code)) + 140 * len(concept_id), "search")
+            ids.extend(concept_id)
+            names.extend(name)
+            codes.extend(code)
+            for values, column, seen in zip(categories, (domain, vocabulary, concept_class, standard), category_values):
+                values.extend(seen.setdefault(v, len(seen)) for v in column)
+            for row, text in enumerate(name, start):
+                add_tokens(row, text)
+
+        query = f"SELECT {', '.join(self.CONCEPT_COLUMNS)} FROM concept ORDER BY concept_id"
+        async for block in _stream_blocks(self.pool, query):
+            await asyncio.to_thread(add_concepts, block)
+        id_array = np.asarray(ids, dtype=np.int64)
+
+        def add_synonyms(block):
+            concept_id, synonym = block
+            rows = np.searchsorted(id_array, np.asarray(concept_id, dtype=np.int64))
+            for row, cid, text in zip(rows.tolist(), concept_id, synonym):
+                if row < len(ids) and ids[row] == cid:
+                    add_tokens(row, text)
+
+        async for block in _stream_blocks(self.pool, "SELECT concept_id, concept_synonym_name FROM concept_synonym"):
+            await asyncio.to_thread(add_synonyms, block)
+
+        def build_postings():
+            # Renumber tokens in sorted order so every prefix covers a contiguous range of postings
+            tokens = list(token_ids)
+            order = sorted(range(len(tokens)), key=tokens.__getitem__)
+            rank = np.empty(len(tokens), dtype=np.int64)
+            rank[order] = np.arange(len(tokens))
+            encoded = np.unique(np.frombuffer(pairs, dtype=np.int64))
+            token_of = rank[encoded >> 32]
+            rows = (encoded & 0xFFFFFFFF).astype(np.int32)
+            by_token = np.lexsort((rows, token_of))
+            offsets = np.zeros(len(tokens) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(token_of, minlength=len(tokens)), out=offsets[1:])
+            return [tokens[i] for i in order], offsets, rows[by_token]
+
+        tokens, token_offsets, postings = await asyncio.to_thread(build_postings)
+        return (
+            id_array,
+            names,
+            codes,
+            [np.asarray(values, dtype=np.uint16) for values in categories],
+            [list(seen) for seen in category_values],
+            np.fromiter((len(n) for n in names), dtype=np.int32, count=len(names)),
+            tokens,
+            token_offsets,
+            postings,
+        )
+
+    async def _load_hierarchy(self):
+        blocks = []
+        try:
+            query = (
+                "SELECT ancestor_concept_id, descendant_concept_id, min_levels_of_separation "
+                "FROM concept_ancestor ORDER BY ancestor_concept_id, min_levels_of_separation, descendant_concept_id"
+            )
+            async for ancestor, descendant, levels in _stream_blocks(self.pool, query):
+                # Blocks are held twice while they are concatenated
+                self._reserve(2 * 10 * len(ancestor), "hierarchy")
+                blocks.append((
+                    np.asarray(ancestor, dtype=np.uint32),
+                    np.asarray(descendant, dtype=np.uint32),
+                    np.minimum(np.asarray(levels, dtype=np.int64), 65535).astype(np.uint16),
+                ))
+        except BaseException:
+            self._settle("hierarchy", 0)
+            raise
+
+        def build_adjacency():
+            columns = [np.concatenate(column) for column in zip(*blocks)] if blocks else [
+                np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.uint16)
+            ]
+            ancestors, starts = np.unique(columns[0], return_index=True)
+            return ancestors, np.append(starts, len(columns[0])), columns[1], columns[2]
+
+        try:
+            adjacency = await asyncio.to_thread(build_adjacency)
+        except BaseException:
+            self._settle("hierarchy", 0)
+            raise
+        self.ancestors, self.descendant_offsets, self.descendants, self.levels = adjacency
+        self._settle("hierarchy", sum(a.nbytes for a in adjacency))
+        logger.info("Loaded %d concept_ancestor rows", len(self.descendants))
+
+    def _term_rows(self, term):
+        lo = bisect.bisect_left(self.tokens, term)
+        if len(term) < self.MIN_PREFIX:
+            hi = lo + (lo < len(self.tokens) and self.tokens[lo] == term)
+        else:
+            hi = bisect.bisect_left(self.tokens, term + "\U0010ffff")
+        matched = self.postings[self.token_offsets[lo]:self.token_offsets[hi]]
+        return matched if hi - lo <= 1 else np.unique(matched)
+
+    def concepts(self, rows):
+        """Concept records of index rows"""
+        return [
+            {
+                "concept_id": int(self.ids[row]),
+                "concept_name": self.names[row],
+                "domain_id": self.category_values[0][self.categories[0][row]],
+                "vocabulary_id": self.category_values[1][self.categories[1][row]],
+                "concept_class_id": self.category_values[2][self.categories[2][row]],
+                "standard_concept": self.category_values[3][self.categories[3][row]],
+                "concept_code": self.codes[row],
+            }
+            for row in rows
+        ]
+
+    def rows_of(self, concept_ids):
+        """Index rows of concept IDs, -1 for unknown ones"""
+        concept_ids = np.asarray(concept_ids, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.ids, concept_ids), max(len(self.ids) - 1, 0))
+        return np.where(self.ids[rows] == concept_ids, rows, -1) if len(self.ids) else np.full(len(concept_ids), -1)
+
+    def search(self, text, domain_id=None, vocabulary_id=None, standard_only=False, limit=20):
+        """Concepts whose name or a synonym contains every term of ``text`` as a word prefix.
+
+        Standard concepts come first, then shorter names. Returns (match count, concepts).
+        """
+        rows = None
+        for term in set(self.TOKEN.findall(text.lower())):
+            matched = self._term_rows(term)
+            rows = matched if rows is None else np.intersect1d(rows, matched, assume_unique=True)
+            if not len(rows):
+                break
+        if rows is None or not len(rows):
+            return 0, []
+        for position, value in ((0, domain_id), (1, vocabulary_id), (3, "S" if standard_only else None)):
+            if value is not None:
+                values = self.category_values[position]
+                code = values.index(value) if value in values else -1
+                rows = rows[self.categories[position][rows] == code]
+        standard_code = self.category_values[3].index("S") if "S" in self.category_values[3] else -1
+        order = np.lexsort((self.ids[rows], self.name_lengths[rows], self.categories[3][rows] != standard_code))
+        return len(rows), self.concepts(rows[order[:limit]])
+
+    def descendants_of(self, concept_id, max_levels=None, include_self=True):
+        """Descendant concept IDs and their minimum levels of separation, closest first"""
+        position = np.searchsorted(self.ancestors, concept_id)
+        if position >= len(self.ancestors) or self.ancestors[position] != concept_id:
+            return np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.uint16)
+        start, end = self.descendant_offsets[position], self.descendant_offsets[position + 1]
+        descendants, levels = self.descendants[start:end], self.levels[start:end]
+        keep = np.ones(len(descendants), dtype=bool)
+        if max_levels is not None:
+            keep &= levels <= max_levels
+        if not include_self:
+            keep &= levels > 0
+        return descendants[keep], levels[keep]
+
+
+class SchemaCache:
+    """Tables and columns of the OMOP database, read from the system tables at most once per ``refresh_interval``"""
+
+    TABLES_QUERY = """
+        SELECT name, engine, total_rows, primary_key, sorting_key, partition_key
+        FROM system.tables
+        WHERE database = currentDatabase() AND NOT is_temporary
+        ORDER BY name
+    """
+    COLUMNS_QUERY = """
+        SELECT table, name, type
+        FROM system.columns
+        WHERE database = currentDatabase()
+        ORDER BY table, position
+    """
+
+    def __init__(self, pool, refresh_interval):
+        self.pool = pool
+        self.refresh_interval = refresh_interval
+        self.tables = None
+        self.loaded_at = None
+        self._lock = asyncio.Lock()
+
+    async def get(self, refresh=False):
+        """Return {table: description}, reloading it when stale"""
+        async with self._lock:
+            if refresh or self.tables is None or time.monotonic() - self.loaded_at >= self.refresh_interval:
+                await self._load()
+            return self.tables
+
+    async def _load(self):
+        async with self.pool.connection() as client:
+            async with asyncio.timeout(self.pool.query_timeout):
+                tables = await client.query(self.TABLES_QUERY)
+                columns = await client.query(self.COLUMNS_QUERY)
+        described = {
+            name: {
+                "engine": engine,
+                "rows": rows,
+                "primary_key": primary_key,
+                "sorting_key": sorting_key,
+                "partition_key": partition_key,
+                "columns": {},
+            }
+            for name, engine, rows, primary_key, sorting_key, partition_key in tables.result_rows
+        }
+        for table, name, column_type in columns.result_rows:
+            if table in described:
+                described[table]["columns"][name] = column_type
+        self.tables = described
+        self.loaded_at = time.monotonic()
+
+
+@dataclass
+class AppContext:
+    pool: ClickHousePool
+    cursors: CursorRegistry
+    cache: QueryCache
+    concepts: ConceptIndex
+    schema: SchemaCache
+    metrics: QueryMetrics
+    admission: AdmissionControl
+
+
+_app_context = None
+# Kept for the life of the process so the metrics endpoint survives sessions coming and going
+_query_metrics = None
+_admission = None
+_app_sessions = 0
+_app_lock = asyncio.Lock()
+
+
+@asynccontextmanager
+async def app_lifespan(server: FastMCP) -> AsyncIterator[AppContext]:
+    """Share one pool across every session for the lifetime of the server process"""
+    global _app_context, _app_sessions, _query_metrics, _admission
+
+    async with _app_lock:
+        if _query_metrics is None:
+            _query_metrics = QueryMetrics(
+                window=int(os.getenv("OMOP_METRICS_WINDOW", 10000)),
+                slow_seconds=float(os.getenv("OMOP_SLOW_QUERY_SECONDS", 5)),
+                slow_log_size=int(os.getenv("OMOP_SLOW_QUERY_LOG_SIZE", 100)),
+            )
+            _, max_running, _ = _connection_budget()
+            _admission = AdmissionControl(
+                max_running=max_running,
+                max_per_session=int(os.getenv("OMOP_MAX_SESSION_QUERIES", max(1, max_running // 2))),
+                max_queued=int(os.getenv("OMOP_MAX_QUEUED_QUERIES", 100)),
+                queue_timeout=float(os.getenv("OMOP_QUEUE_TIMEOUT", 60)),
+            )
+        if _app_context is None:
+            pool_size, _, max_open = _connection_budget()
+            pool = _create_pool(pool_size)
+            await pool.open()
+            guard = QueryGuard(
+                default_limit=int(os.getenv("CLICKHOUSE_DEFAULT_LIMIT", 10000)),
+                settings={
+                    "max_execution_time": int(os.getenv("CLICKHOUSE_MAX_EXECUTION_TIME", 60)),
+                    "max_result_rows": int(os.getenv("CLICKHOUSE_MAX_RESULT_ROWS", 1_000_000)),
+                    "result_overflow_mode": os.getenv("CLICKHOUSE_RESULT_OVERFLOW_MODE", "throw"),
+                    "max_memory_usage": int(os.getenv("CLICKHOUSE_MAX_MEMORY_USAGE", 4_000_000_000)),
+                    "max_threads": int(os.getenv("CLICKHOUSE_MAX_THREADS", 8)),
+                },
+            )
+            cursors = CursorRegistry(
+                pool,
+                guard,
+                max_open=max_open,
+                ttl=float(os.getenv("OMOP_CURSOR_TTL", 300)),
+                page_rows=int(os.getenv("OMOP_PAGE_MAX_ROWS", 1000)),
+                page_bytes=int(os.getenv("OMOP_PAGE_MAX_BYTES", 1_000_000)),
+            )
+            cache = QueryCache(
+                max_entries=int(os.getenv("OMOP_CACHE_MAX_ENTRIES", 1000)),
+                max_bytes=int(os.getenv("OMOP_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+                ttl=float(os.getenv("OMOP_CACHE_TTL", 3600)),
+                generation_check_interval=float(os.getenv("OMOP_CACHE_GENERATION_CHECK_INTERVAL", 10)),
+            )
+            concepts = ConceptIndex(pool, max_bytes=int(os.getenv("OMOP_CONCEPT_INDEX_MAX_BYTES", 1024**3)))
+            if os.getenv("OMOP_CONCEPT_INDEX_PRELOAD", "1") != "0":
+                concepts.preload()
+            schema = SchemaCache(pool, refresh_interval=float(os.getenv("OMOP_SCHEMA_REFRESH_INTERVAL", 300)))
+            _app_context = AppContext(
+                pool=pool, cursors=cursors, cache=cache, concepts=concepts, schema=schema,
+                metrics=_query_metrics, admission=_admission,
+            )
+        _app_sessions += 1
+    try:
+        yield _app_context
+    finally:
+        # Shielded, as the last session ends while its task group is being cancelled and an
+        # interrupted teardown would leave a closed context for the next session
+        with anyio.CancelScope(shield=True):
+            async with _app_lock:
+                _app_sessions -= 1
+                if _app_sessions == 0:
+                    app, _app_context = _app_context, None
+                    await app.concepts.close()
+                    await app.cursors.close()
+                    await app.pool.close()
+
+
+def _to_json(value):
+    return pydantic_core.to_json(value, fallback=str).decode()
+
+
+async def _run_query(ctx, query, page_size=None, result_format="rows", sample=None, priority="light"):
+    """Run a query through the result cache and return its first page.
+
+    Cache misses wait for an execution slot of the given admission priority.
+    When given, ``sample`` is filled in with the query ID, the time spent queued,
+    the rows and bytes read by ClickHouse, the size of the page and the time
+    spent serializing it.
+    """
+    app = ctx.request_context.lifespan_context
+    sample = {} if sample is None else sample
+    sample["priority"] = priority
+    key = app.cache.key(app.pool.database, query, app.cursors.limits(page_size), result_format)
+    if key is not None:
+        await app.cache.check_generation(app.pool)
+        cached = app.cache.get(key)
+        if cached is not None:
+            sample["cached"] = True
+            sample["result_bytes"] = len(cached)
+            return cached
+    async with app.admission.slot(ctx.session, priority) as waited:
+        sample["queue_seconds"] = waited
+        cursor, columns, token = await app.cursors.execute(query, page_size)
+    start = time.perf_counter()
+    page = _page(cursor, columns, token, result_format)
+    sample["serialize_seconds"] = time.perf_counter() - start
+    sample["query_id"] = cursor.query_id
+    sample["read_rows"] = int(cursor.summary.get("read_rows", 0))
+    sample["read_bytes"] = int(cursor.summary.get("read_bytes", 0))
+    sample["result_rows"] = len(columns[0]) if columns else 0
+    sample["result_bytes"] = len(page)
+    # Only complete results are cached, paged ones depend on an open cursor
+    if key is not None and token is None:
+        app.cache.put(key, page)
+    return page
+
+
+def _id_filter(column, ids):
+    """SQL condition restricting a column to a list of integer IDs"""
+    if not ids:
+        return "1"
+    return f"{column} IN ({', '.join(str(int(i)) for i in ids)})"
+
+
+def _with_concept_names(rollup_query, concept_column, order_by):
+    """Join concept names onto a rollup query, looking up only the concepts it returns"""
+    return f"""
+        WITH counts AS ({rollup_query})
+        SELECT counts.*, names.concept_name AS concept_name
+        FROM counts
+        LEFT JOIN (
+            SELECT concept_id, concept_name FROM concept
+            WHERE concept_id IN (SELECT {concept_column} FROM counts)
+        ) AS names ON names.concept_id = counts.{concept_column}
+        ORDER BY {order_by}
+    """
+
+
+def _concept_search_sql(text, domain_id=None, vocabulary_id=None, standard_only=False, limit=20):
+    """SQL equivalent of ConceptIndex.search, matching terms anywhere in names and synonyms"""
+    conditions = []
+    for term in sorted(set(ConceptIndex.TOKEN.findall(text.lower()))):
+        term = _sql_string(term)
+        conditions.append(
+            f"(positionCaseInsensitiveUTF8(concept_name, {term}) > 0 OR concept_id IN ("
+            f"SELECT concept_id FROM concept_synonym WHERE positionCaseInsensitiveUTF8(concept_synonym_name, {term}) > 0))"
+        )
+    if not conditions:
+        conditions.append("0")
+    if domain_id is not None:
+        conditions.append(f"domain_id = {_sql_string(domain_id)}")
+    if vocabulary_id is not None:
+        conditions.append(f"vocabulary_id = {_sql_string(vocabulary_id)}")
+    if standard_only:
+        conditions.append("standard_concept = 'S'")
+    return f"""
+        SELECT {', '.join(ConceptIndex.CONCEPT_COLUMNS)}
+        FROM concept
+        WHERE {' AND '.join(conditions)}
+        ORDER BY standard_concept != 'S', length(concept_name), concept_id
+        LIMIT {int(limit)}
+    """
+
+
+# Create an MCP server
+mcp = FastMCP("OmopServer", lifespan=app_lifespan)
+
+@mcp.tool()
+async def query_omop_database(
+    query: str, ctx: Context, page_size: int | None = None, format: str = "rows"
+) -> str:
+    """Query the OMOP database and return the first page of results.
+
+    With format "rows" (default) rows are dictionaries with column names as keys.
+    Format "columns" returns column names and types once plus one array per column
+    in `data`, which is much smaller for wide tables; "arrow" returns the page as a
+    base64 Arrow IPC stream. When the result does not fit in one page, `has_more`
+    is true and `cursor` can be passed to `fetch_omop_results` to read the next page.
+    Use `describe_schema` rather than SHOW TABLES / DESCRIBE queries to look up tables.
+    """
+
+    _check_format(format)
+    app = ctx.request_context.lifespan_context
+    async with app.metrics.measure(query) as sample:
+        return await _run_query(ctx, query, page_size, format, sample, priority=query_priority(query))
+
+
+@mcp.tool()
+async def fetch_omop_results(
+    cursor: str, ctx: Context, page_size: int | None = None, format: str = "rows"
+) -> str:
+    """Fetch the next page of results for a cursor returned by `query_omop_database`"""
+
+    _check_format(format)
+    app = ctx.request_context.lifespan_context
+    # The query is already running, so reading on is cheap compared to starting a scan
+    async with app.admission.slot(ctx.session, "light"):
+        page = await app.cursors.fetch(cursor, page_size)
+    return _page(*page, format)
+
+
+@mcp.tool()
+async def close_omop_cursor(cursor: str, ctx: Context) -> dict:
+    """Release a cursor whose remaining results are not needed"""
+
+    await ctx.request_context.lifespan_context.cursors.discard(cursor)
+    return {"closed": cursor}
+
+
+@mcp.tool()
+async def condition_patient_counts(
+    ctx: Context, condition_concept_ids: list[int] | None = None, limit: int = 20
+) -> str:
+    """Count patients and records per condition concept.
+
+    Returns the given condition concepts, or the `limit` most frequent ones, from a
+    rollup kept up to date at load time, without scanning condition_occurrence.
+    """
+
+    rollup = f"""
+        SELECT condition_concept_id, uniqExactMerge(persons) AS patients, sum(records) AS records
+        FROM condition_concept_counts
+        WHERE {_id_filter("condition_concept_id", condition_concept_ids)}
+        GROUP BY condition_concept_id
+        ORDER BY patients DESC, condition_concept_id
+        LIMIT {int(limit)}
+    """
+    query = _with_concept_names(rollup, "condition_concept_id", "patients DESC, condition_concept_id")
+    return await _run_query(ctx, query)
+
+
+@mcp.tool()
+async def drug_exposure_counts(
+    ctx: Context, drug_concept_ids: list[int] | None = None, limit: int = 20
+) -> str:
+    """Count patients and exposure records per drug concept.
+
+    Returns the given drug concepts, or the `limit` most frequent ones, from a rollup
+    kept up to date at load time, without scanning drug_exposure.
+    """
+
+    rollup = f"""
+        SELECT drug_concept_id, uniqExactMerge(persons) AS patients, sum(records) AS records
+        FROM drug_concept_counts
+        WHERE {_id_filter("drug_concept_id", drug_concept_ids)}
+        GROUP BY drug_concept_id
+        ORDER BY patients DESC, drug_concept_id
+        LIMIT {int(limit)}
+    """
+    query = _with_concept_names(rollup, "drug_concept_id", "patients DESC, drug_concept_id")
+    return await _run_query(ctx, query)
+
+
+@mcp.tool()
+async def age_gender_distribution(ctx: Context, age_band_years: int = 10) -> str:
+    """Count persons per gender and age band (current age, from year of birth)"""
+
+    band = max(1, int(age_band_years))
+    rollup = f"""
+        SELECT
+            gender_concept_id,
+            intDiv(toYear(today()) - year_of_birth, {band}) * {band} AS age_band_start,
+            sum(persons) AS persons
+        FROM person_demographics
+        GROUP BY gender_concept_id, age_band_start
+    """
+    query = _with_concept_names(rollup, "gender_concept_id", "gender_concept_id, age_band_start")
+    return await _run_query(ctx, query)
+
+
+@mcp.tool()
+async def visit_counts_per_year(ctx: Context, visit_concept_ids: list[int] | None = None) -> str:
+    """Count visits and visiting patients per year and visit concept"""
+
+    rollup = f"""
+        SELECT visit_year, visit_concept_id, sum(visits) AS visits, uniqExactMerge(persons) AS patients
+        FROM visit_year_counts
+        WHERE {_id_filter("visit_concept_id", visit_concept_ids)}
+        GROUP BY visit_year, visit_concept_id
+    """
+    query = _with_concept_names(rollup, "visit_concept_id", "visit_year, visit_concept_id")
+    return await _run_query(ctx, query)
+
+
+@mcp.tool()
+async def search_concepts(
+    query: str,
+    ctx: Context,
+    domain_id: str | None = None,
+    vocabulary_id: str | None = None,
+    standard_only: bool = False,
+    limit: int = 20,
+) -> str:
+    """Find concepts whose name or a synonym contains every word of `query`.
+
+    Words match as prefixes ("diab mell" finds "Diabetes mellitus"); standard
+    concepts and shorter names come first. Filter with `domain_id` (e.g.
+    "Condition", "Drug"), `vocabulary_id` (e.g. "SNOMED") or `standard_only`.
+    `match_count` is the total number of matches when served from the in-memory index.
+    """
+
+    app = ctx.request_context.lifespan_context
+    limit = max(1, int(limit))
+    if app.concepts.ready("search"):
+        match_count, rows = app.concepts.search(query, domain_id, vocabulary_id, standard_only, limit)
+        return _to_json({
+            "columns": list(ConceptIndex.CONCEPT_COLUMNS),
+            "rows": rows,
+            "row_count": len(rows),
+            "match_count": match_count,
+        })
+    return await _run_query(ctx, _concept_search_sql(query, domain_id, vocabulary_id, standard_only, limit))
+
+
+@mcp.tool()
+async def concept_descendants(
+    concept_id: int,
+    ctx: Context,
+    max_levels: int | None = None,
+    include_self: bool = True,
+    limit: int = 100,
+) -> str:
+    """List the descendants of a concept through concept_ancestor, closest first.
+
+    `max_levels` limits the levels of separation. At most `limit` descendants are
+    listed; `descendant_count` gives the total when served from the in-memory index.
+    To filter on a large hierarchy in SQL, use `IN (SELECT descendant_concept_id
+    FROM concept_ancestor WHERE ancestor_concept_id = ...)`.
+    """
+
+    app = ctx.request_context.lifespan_context
+    limit = max(1, int(limit))
+    if app.concepts.ready("hierarchy"):
+        descendants, levels = app.concepts.descendants_of(int(concept_id), max_levels, include_self)
+        rows = [
+            {"concept_id": int(descendant), "min_levels_of_separation": int(level)}
+            for descendant, level in zip(descendants[:limit], levels[:limit])
+        ]
+        if app.concepts.ready("search"):
+            index_rows = app.concepts.rows_of([row["concept_id"] for row in rows])
+            for row, index_row in zip(rows, index_rows.tolist()):
+                if index_row >= 0:
+                    row.update(app.concepts.concepts([index_row])[0])
+        return _to_json({
+            "concept_id": int(concept_id),
+            "rows": rows,
+            "row_count": len(rows),
+            "descendant_count": len(descendants),
+            "truncated": len(descendants) > limit,
+        })
+
+    conditions = [f"ancestor_concept_id = {int(concept_id)}"]
+    if max_levels is not None:
+        conditions.append(f"min_levels_of_separation <= {int(max_levels)}")
+    if not include_self:
+        conditions.append("min_levels_of_separation > 0")
+    descendants = f"""
+        SELECT descendant_concept_id AS concept_id, min_levels_of_separation
+        FROM concept_ancestor
+        WHERE {' AND '.join(conditions)}
+        ORDER BY min_levels_of_separation, concept_id
+        LIMIT {limit}
+    """
+    query = _with_concept_names(descendants, "concept_id", "min_levels_of_separation, concept_id")
+    return await _run_query(ctx, query)
+
+
+async def _describe(app, tables=None, refresh=False):
+    described = await app.schema.get(refresh)
+    if tables:
+        unknown = sorted(set(tables) - set(described))
+        if unknown:
+            raise ValueError(f"Unknown tables: {', '.join(unknown)}")
+        described = {name: described[name] for name in tables}
+    return _to_json(described)
+
+
+@mcp.tool()
+async def describe_schema(ctx: Context, tables: list[str] | None = None, refresh: bool = False) -> str:
+    """Describe the OMOP tables: engine, row count, primary/sorting/partition keys and column types.
+
+    Describes every table unless `tables` is given. Served from a cache refreshed
+    periodically; pass `refresh` after loading data to re-read it immediately.
+    """
+
+    return await _describe(ctx.request_context.lifespan_context, tables, refresh)
+
+
+@mcp.resource("omop://schema", name="omop_schema", mime_type="application/json")
+async def schema_resource() -> str:
+    """Every OMOP table with its row count, keys and column types"""
+
+    return await _describe(mcp.get_context().request_context.lifespan_context)
+
+
+@mcp.resource("omop://schema/{table}", name="omop_table_schema", mime_type="application/json")
+async def table_schema_resource(table: str) -> str:
+    """Row count, keys and column types of one OMOP table"""
+
+    return await _describe(mcp.get_context().request_context.lifespan_context, [table])
+
+
+@mcp.tool()
+async def query_cache_stats(ctx: Context) -> dict:
+    """Return query result cache size and hit/miss counters"""
+
+    return ctx.request_context.lifespan_context.cache.stats()
+
+
+@mcp.tool()
+async def query_stats(ctx: Context) -> dict:
+    """Return latency percentiles, rows/bytes read and the slow query log of `query_omop_database`.
+
+    `admission` reports the queries running per priority, the queue depth and queue wait times.
+    """
+
+    app = ctx.request_context.lifespan_context
+    return {**app.metrics.stats(), "admission": app.admission.stats()}
+
+
+@mcp.custom_route("/metrics", methods=["GET"])
+async def prometheus_metrics(request: Request) -> Response:
+    """Prometheus scrape endpoint, served with the SSE and streamable HTTP transports"""
+
+    body = "".join(metrics.prometheus() for metrics in (_query_metrics, _admission) if metrics is not None)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
 
 
 if __name__ == "__main__":
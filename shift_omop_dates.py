@@ -1,15 +1,21 @@
 import os
+import argparse
+import contextlib
 import gzip
+import hashlib
+import io
+import time
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
+from incremental import iter_appended_rows, load_manifest, plan_file, record_output, save_manifest
+from omop_schema import OUTPUT_FORMATS, check_output_format, output_filename, write_parquet
 
 # Directory paths
 INPUT_DIR = 'omop_data_csv_bak'
 OUTPUT_DIR = 'omop_data_csv_shifted'
 
-# Ensure output directory exists
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
 # OMOP date/datetime columns by table (from your schema)
 DATE_COLUMNS = {
     'visit_occurrence': ['visit_start_date', 'visit_start_datetime', 'visit_end_date', 'visit_end_datetime'],
@@ -65,78 +71,6 @@ def get_delimiter(filename):
             return '\t'
     return ','
 
-# Step 1: Load person table and get birth dates
-person_file = 'person.csv.gz'
-person_path = os.path.join(INPUT_DIR, person_file)
-person_out_path = os.path.join(OUTPUT_DIR, person_file)
-person_id_birth = {}
-person_id_rowidx = {}
-
-if os.path.exists(person_path):
-    with gzip.open(person_path, 'rt') as f:
-        df_person = pd.read_csv(f)
-    for idx, row in df_person.iterrows():
-        pid = row['person_id']
-        y = int(row['year_of_birth'])
-        birth = datetime(y, 1, 1)
-        person_id_birth[pid] = birth
-        person_id_rowidx[pid] = idx
-else:
-    raise FileNotFoundError(f"person.csv.gz not found in {INPUT_DIR}")
-
-# Step 2: Load death table and map person_id to death date
-death_file = 'death.csv.gz'
-death_path = os.path.join(INPUT_DIR, death_file)
-person_id_death = {}
-if os.path.exists(death_path):
-    with gzip.open(death_path, 'rt') as f:
-        df_death = pd.read_csv(f, low_memory=False)
-    if 'death_date' in df_death.columns:
-        df_death['death_date'] = pd.to_datetime(df_death['death_date'], errors='coerce')
-        for idx, row in df_death.iterrows():
-            pid = row['person_id']
-            if pd.notnull(row['death_date']):
-                person_id_death[pid] = row['death_date']
-
-# Step 3: For each person, find last event date (last visit)
-visit_file = 'visit_occurrence.csv.gz'
-visit_path = os.path.join(INPUT_DIR, visit_file)
-person_id_last_event = {}
-if os.path.exists(visit_path):
-    with gzip.open(visit_path, 'rt') as f:
-        df_visit = pd.read_csv(f, low_memory=False)
-    if 'visit_end_date' in df_visit.columns:
-        df_visit['visit_end_date'] = pd.to_datetime(df_visit['visit_end_date'], errors='coerce')
-    for pid, birth in person_id_birth.items():
-        visits = df_visit[df_visit['person_id'] == pid]
-        if not visits.empty:
-            last_visit = visits['visit_end_date'].dropna().max()
-            if pd.notnull(last_visit):
-                person_id_last_event[pid] = last_visit
-
-# Step 4: For each person, determine interval, max_shift, and random shift
-SHIFT_END = 2024
-SHIFT_START = SHIFT_END - 100
-person_id_shift_years = {}
-for pid, birth in person_id_birth.items():
-    # Determine end of interval
-    if pid in person_id_death:
-        end = person_id_death[pid]
-    elif pid in person_id_last_event:
-        end = person_id_last_event[pid]
-    else:
-        end = birth  # No events, no shift
-    interval_years = max(0, (end.year - birth.year))
-    print("Interval years", interval_years)
-    max_shift = (SHIFT_END - SHIFT_START) - interval_years
-    shift = SHIFT_START - birth.year
-    # Deterministic random: use person_id as seed
-    rnd = abs(hash(pid))
-    shift += rnd % (max_shift)
-    if shift < 0:
-        shift = 0
-    person_id_shift_years[pid] = shift
-
 # Step 5: Shift all dates for each person in all tables
 def shift_date(dt, shift_years, col):
     if pd.isnull(dt):
@@ -158,6 +92,57 @@ def shift_date(dt, shift_years, col):
     except Exception:
         return dt
 
+def shift_dates(values, shifts, col):
+    """Vectorized shift_date: shift a column of dates by a per-row number of years.
+
+    Produces the same strings as applying shift_date row by row: Feb 29 falls back
+    to Feb 28 in non-leap target years, dates are capped at the end of 2024 and
+    unparseable values become missing. Values whose shifted year falls outside the
+    range pandas timestamps can represent go through shift_date itself.
+    """
+    if values.dtype != object:
+        return pd.Series([shift_date(v, s, col) if pd.notnull(v) else v for v, s in zip(values, shifts)], index=values.index, dtype=object)
+    is_datetime = 'datetime' in col
+    present = values.notna()
+    parsed = pd.to_datetime(values.where(present), errors='coerce', format='ISO8601')
+    # Anything the ISO 8601 fast path rejects gets per-value format inference, as in shift_date
+    retry = present & parsed.isna()
+    if retry.any():
+        parsed[retry] = pd.to_datetime(values[retry], errors='coerce', format='mixed')
+    shifts = np.asarray(shifts, dtype='int64')
+    target_year = parsed.dt.year.to_numpy(dtype='float64', na_value=np.nan) + shifts
+    in_range = (target_year > 1677) & (target_year < 2262)
+    fallback = (parsed.notna() & ~in_range).to_numpy()
+    ok = parsed.notna().to_numpy() & ~fallback
+
+    result = values.copy()
+    result[present.to_numpy() & ~fallback] = np.nan
+    if ok.any():
+        stamps = parsed.to_numpy()[ok]
+        year_shift = shifts[ok]
+        # Add whole years as 12-month steps on the month start, then restore day and time of day
+        month_start = stamps.astype('datetime64[M]')
+        shifted = (month_start + (year_shift * 12).astype('timedelta64[M]')).astype('datetime64[ns]')
+        shifted = shifted + (stamps - month_start.astype('datetime64[ns]'))
+        # Feb 29 rolls over to Mar 1 in non-leap target years, DateOffset clips it to Feb 28
+        year = target_year[ok].astype('int64')
+        leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+        feb29 = (parsed.dt.month.to_numpy()[ok] == 2) & (parsed.dt.day.to_numpy()[ok] == 29)
+        shifted[feb29 & ~leap] -= np.timedelta64(1, 'D')
+        cap = np.datetime64('2024-12-31T23:59:59' if is_datetime else '2024-12-31', 'ns')
+        capped = shifted > cap
+        if capped.any():
+            print(f"  Capping {capped.sum()} {col} values at {pd.Timestamp(cap)}")
+            shifted[capped] = cap
+        if is_datetime:
+            text = np.char.replace(np.datetime_as_string(shifted, unit='s'), 'T', ' ')
+        else:
+            text = np.datetime_as_string(shifted, unit='D')
+        result[ok] = text
+    if fallback.any():
+        result[fallback] = [shift_date(v, s, col) for v, s in zip(values[fallback], shifts[fallback])]
+    return result
+
 def convert_id_columns_to_int(df):
     for col in df.columns:
         if col.endswith('_id') or col == 'id':
@@ -179,50 +164,281 @@ def convert_quantity_column(df, table):
         except Exception:
             pass
 
-# Shift year_of_birth in person table and write output
-for pid, shift in person_id_shift_years.items():
-    idx = person_id_rowidx[pid]
-    print("Shifting year_of_birth for person_id", pid, "by", shift, "years", df_person.at[idx, 'year_of_birth'])
-    df_person.at[idx, 'year_of_birth'] = int(df_person.at[idx, 'year_of_birth']) + shift
-    print(df_person.at[idx, 'year_of_birth'])
+# Person shifts shared with worker processes, see _init_worker
+_PERSON_SHIFTS = None
 
-# Convert id columns to int
-convert_id_columns_to_int(df_person)
+SHIFT_END = 2024
+SHIFT_START = SHIFT_END - 100
+
+# Per-person shifts kept in the state directory, as (person_id, years) rows
+SHIFTS_FILE = 'person_shifts.npy'
+
+def stable_hash(pid, salt=''):
+    """64-bit BLAKE2b hash of a person_id keyed with the salt, the same in every run and process"""
+    digest = hashlib.blake2b(str(int(pid)).encode(), key=salt.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+def salt_fingerprint(salt):
+    """Identifies the salt in the state directory without storing it"""
+    return hashlib.blake2b(b'omop-shift-salt', key=salt.encode(), digest_size=16).hexdigest()
+
+def load_person_shifts(state_dir):
+    """Return {person_id: years} persisted by a previous run"""
+    path = os.path.join(state_dir, SHIFTS_FILE)
+    if not os.path.exists(path):
+        return {}
+    shifts = np.load(path)
+    return dict(zip(shifts[:, 0].tolist(), shifts[:, 1].tolist()))
 
-with gzip.open(person_out_path, 'wt', newline='') as f:
-    df_person.to_csv(f, index=False, na_rep='')
+def save_person_shifts(state_dir, person_id_shift_years):
+    os.makedirs(state_dir, exist_ok=True)
+    path = os.path.join(state_dir, SHIFTS_FILE)
+    shifts = np.array(list(person_id_shift_years.items()), dtype='int64').reshape(-1, 2)
+    with open(f"{path}.tmp", 'wb') as f:
+        np.save(f, shifts)
+    os.replace(f"{path}.tmp", path)
 
+def compute_person_shifts(salt='', known_shifts=None):
+    """Compute the number of years to shift each person by.
 
+    Persons in `known_shifts` keep the shift they were given by a previous run, so rows already
+    written stay consistent with new ones. Returns the person table, the shift per person_id and
+    the person table row of each person_id.
+    """
+    known_shifts = known_shifts or {}
+    # Step 1: Load person table and get birth dates
+    person_file = 'person.csv.gz'
+    person_path = os.path.join(INPUT_DIR, person_file)
+    person_id_birth = {}
+    person_id_rowidx = {}
 
-for fname in os.listdir(INPUT_DIR):
-    if not fname.endswith('.csv.gz'):
-        continue
+    if os.path.exists(person_path):
+        with gzip.open(person_path, 'rt') as f:
+            df_person = pd.read_csv(f)
+        for idx, row in df_person.iterrows():
+            pid = row['person_id']
+            y = int(row['year_of_birth'])
+            birth = datetime(y, 1, 1)
+            person_id_birth[pid] = birth
+            person_id_rowidx[pid] = idx
+    else:
+        raise FileNotFoundError(f"person.csv.gz not found in {INPUT_DIR}")
+
+    # Step 2: Load death table and map person_id to death date
+    death_file = 'death.csv.gz'
+    death_path = os.path.join(INPUT_DIR, death_file)
+    person_id_death = {}
+    if os.path.exists(death_path):
+        with gzip.open(death_path, 'rt') as f:
+            df_death = pd.read_csv(f, low_memory=False)
+        if 'death_date' in df_death.columns:
+            df_death['death_date'] = pd.to_datetime(df_death['death_date'], errors='coerce')
+            for idx, row in df_death.iterrows():
+                pid = row['person_id']
+                if pd.notnull(row['death_date']):
+                    person_id_death[pid] = row['death_date']
+
+    # Step 3: For each person, find last event date (last visit)
+    visit_file = 'visit_occurrence.csv.gz'
+    visit_path = os.path.join(INPUT_DIR, visit_file)
+    person_id_last_event = {}
+    if os.path.exists(visit_path):
+        with gzip.open(visit_path, 'rt') as f:
+            df_visit = pd.read_csv(f, low_memory=False)
+        if 'visit_end_date' in df_visit.columns:
+            df_visit['visit_end_date'] = pd.to_datetime(df_visit['visit_end_date'], errors='coerce')
+        # One pass over all visits instead of filtering the table once per person
+        known_visits = df_visit[df_visit['person_id'].isin(list(person_id_birth))]
+        last_visits = known_visits.groupby('person_id')['visit_end_date'].max().dropna()
+        person_id_last_event = last_visits.to_dict()
+
+    # Step 4: For each person, determine interval, max_shift, and random shift
+    person_id_shift_years = {}
+    for pid, birth in person_id_birth.items():
+        if pid in known_shifts:
+            person_id_shift_years[pid] = known_shifts[pid]
+            continue
+        # Determine end of interval
+        if pid in person_id_death:
+            end = person_id_death[pid]
+        elif pid in person_id_last_event:
+            end = person_id_last_event[pid]
+        else:
+            end = birth  # No events, no shift
+        interval_years = max(0, (end.year - birth.year))
+        print("Interval years", interval_years)
+        max_shift = (SHIFT_END - SHIFT_START) - interval_years
+        shift = SHIFT_START - birth.year
+        # Deterministic random: a salted hash of person_id, unlike hash() stable across runs
+        rnd = stable_hash(pid, salt)
+        # Spans longer than the window (negative max_shift) are shifted as before; a span of exactly
+        # the window has no room to move and would divide by zero
+        if max_shift != 0:
+            shift += rnd % max_shift
+        if shift < 0:
+            shift = 0
+        person_id_shift_years[pid] = shift
+
+    return df_person, person_id_shift_years, person_id_rowidx
+
+def write_table(df, table, delimiter=',', output_format='csv', append=False):
+    """Write a shifted table to the output directory, or append its rows to the gzipped CSV there"""
+    out_path = os.path.join(OUTPUT_DIR, output_filename(table, output_format))
+    if output_format == 'parquet':
+        write_parquet(df, table, out_path)
+        return
+    # Appending adds a gzip member, which gzip readers and ClickHouse read as one stream
+    with gzip.open(out_path, 'at' if append else 'wt', newline='') as f:
+        df.to_csv(f, index=False, sep=delimiter, na_rep='', header=not append)
+
+def write_person_table(df_person, person_id_shift_years, person_id_rowidx, output_format='csv'):
+    """Shift year_of_birth in the person table and write it out"""
+    shifted_rows = [person_id_rowidx[pid] for pid in person_id_shift_years]
+    shifted_years = [person_id_shift_years[pid] for pid in person_id_shift_years]
+    print("Shifting year_of_birth for", len(shifted_rows), "persons")
+    df_person.loc[shifted_rows, 'year_of_birth'] = df_person.loc[shifted_rows, 'year_of_birth'].astype(int) + shifted_years
+
+    # Convert id columns to int
+    convert_id_columns_to_int(df_person)
+
+    write_table(df_person, 'person', output_format=output_format)
+
+def shift_table_file(fname, person_shifts, output_format='csv', append_from=None):
+    """Shift the dates of one table file according to the person_id -> years Series.
+
+    With `append_from`, only the rows starting at that offset of the decompressed file are shifted
+    and appended to the existing output.
+    """
     table = get_table_name(fname)
     date_cols = DATE_COLUMNS.get(table, [])
+    # Tables without date columns are not written out
+    if not date_cols:
+        return
     in_path = os.path.join(INPUT_DIR, fname)
-    out_path = os.path.join(OUTPUT_DIR, fname)
-    if out_path == person_out_path:
-        continue
     delimiter = get_delimiter(fname)
-    with gzip.open(in_path, 'rt') as f:
-        df = pd.read_csv(f, delimiter=delimiter, low_memory=False)
-    # If no person_id or no date columns, just copy
-    if 'person_id' not in df.columns or not date_cols:
-        continue
-    # Shift dates for each row according to person_id
-    def shift_row(row):
-        shift = person_id_shift_years.get(row['person_id'], 0)
-        for col in date_cols:
-            if col in row and pd.notnull(row[col]):
-                row[col] = shift_date(row[col], shift, col)
-        return row
-    df = df.apply(shift_row, axis=1)
+    if append_from is not None:
+        df = next(iter_appended_rows(in_path, append_from, delimiter))
+        print(f"  {table}: shifting {len(df)} appended rows")
+    else:
+        with gzip.open(in_path, 'rt') as f:
+            df = pd.read_csv(f, delimiter=delimiter, low_memory=False)
+    # Tables without person_id are not written out either
+    if 'person_id' not in df.columns:
+        return
+    # Shift dates column by column according to person_id
+    shifts = df['person_id'].map(person_shifts).fillna(0).astype('int64')
+    for col in date_cols:
+        if col in df.columns:
+            df[col] = shift_dates(df[col], shifts, col)
 
     # Convert id columns to int before writing
     convert_id_columns_to_int(df)
     convert_quantity_column(df, table)
     # Write out
-    with gzip.open(out_path, 'wt', newline='') as f:
-        df.to_csv(f, index=False, sep=delimiter, na_rep='')
+    write_table(df, table, delimiter, output_format, append=append_from is not None)
+
+def _init_worker(person_ids, shifts):
+    global _PERSON_SHIFTS
+    _PERSON_SHIFTS = pd.Series(shifts, index=person_ids)
+
+def _shift_table_worker(fname, output_format, append_from=None):
+    """Shift one table in a worker process, returning its captured output and duration"""
+    start = time.perf_counter()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        shift_table_file(fname, _PERSON_SHIFTS, output_format, append_from)
+    return fname, output.getvalue(), time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Shift OMOP dates by a per-person number of years.")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="Number of worker processes shifting tables in parallel (default: 1)")
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='csv',
+                        help="Write gzipped CSV, or typed zstd Parquet that ClickHouse loads without "
+                             "parsing text (default: csv)")
+    parser.add_argument('--salt', default=os.getenv('OMOP_SHIFT_SALT', ''),
+                        help="Secret key of the hash choosing each person's shift, at most 64 bytes "
+                             "(default: $OMOP_SHIFT_SALT)")
+    parser.add_argument('--state-dir', default=None,
+                        help="Persist the per-person shifts and a manifest of processed files in this "
+                             "directory; later runs keep the shifts and only process new or changed files, "
+                             "and only the rows appended to a file since the last run")
+    args = parser.parse_args()
+    try:
+        check_output_format(args.output_format)
+    except ValueError as e:
+        parser.error(str(e))
+    if len(args.salt.encode()) > 64:
+        parser.error("--salt must be at most 64 bytes")
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    manifest, known_shifts = {}, {}
+    if args.state_dir:
+        known_shifts = load_person_shifts(args.state_dir)
+        manifest = load_manifest(args.state_dir) if known_shifts else {}
+        if known_shifts and manifest.get(SHIFTS_FILE, {}).get('salt') != salt_fingerprint(args.salt):
+            parser.error(f"--salt differs from the one the shifts in {args.state_dir} were made with")
+
+    def output_path(fname):
+        return os.path.join(OUTPUT_DIR, output_filename(get_table_name(fname), args.output_format))
+
+    def plan(fname):
+        if not args.state_dir or not os.path.exists(os.path.join(INPUT_DIR, fname)):
+            return 'full', None, None
+        return plan_file(os.path.join(INPUT_DIR, fname), manifest.get(fname), output_path(fname), args.output_format)
+
+    def finished(fname, entry):
+        if args.state_dir:
+            manifest[fname] = record_output(entry, output_path(fname), args.output_format)
+            save_manifest(args.state_dir, manifest)
+
+    action, entry, _ = plan('person.csv.gz')
+    if action == 'skip':
+        print(f"person.csv.gz unchanged, reusing the shifts of {len(known_shifts)} persons")
+        person_id_shift_years = known_shifts
+    else:
+        df_person, person_id_shift_years, person_id_rowidx = compute_person_shifts(args.salt, known_shifts)
+        write_person_table(df_person, person_id_shift_years, person_id_rowidx, args.output_format)
+        person_id_shift_years = {**known_shifts, **person_id_shift_years}
+        if args.state_dir:
+            save_person_shifts(args.state_dir, person_id_shift_years)
+            manifest[SHIFTS_FILE] = {'salt': salt_fingerprint(args.salt), 'persons': len(person_id_shift_years)}
+            finished('person.csv.gz', entry)
+
+    person_ids = np.array(list(person_id_shift_years))
+    shifts = np.array(list(person_id_shift_years.values()), dtype='int64')
+    fnames = [fname for fname in os.listdir(INPUT_DIR) if fname.endswith('.csv.gz') and fname != 'person.csv.gz']
+    # Largest tables first so they do not end up alone at the tail of the run
+    fnames.sort(key=lambda fname: os.path.getsize(os.path.join(INPUT_DIR, fname)), reverse=True)
+    plans = {fname: plan(fname) for fname in fnames}
+    skipped = [fname for fname in fnames if plans[fname][0] == 'skip']
+    if skipped:
+        print(f"Skipping {len(skipped)} unchanged files")
+    fnames = [fname for fname in fnames if plans[fname][0] != 'skip']
+
+    timings = {}
+    if args.jobs > 1:
+        # Workers receive the person shifts once, as two arrays, instead of with every table
+        with ProcessPoolExecutor(args.jobs, initializer=_init_worker, initargs=(person_ids, shifts)) as executor:
+            futures = [executor.submit(_shift_table_worker, fname, args.output_format, plans[fname][2])
+                       for fname in fnames]
+            for future in as_completed(futures):
+                fname, output, seconds = future.result()
+                print(output, end='')
+                timings[fname] = seconds
+                finished(fname, plans[fname][1])
+    else:
+        _init_worker(person_ids, shifts)
+        for fname in fnames:
+            fname, output, seconds = _shift_table_worker(fname, args.output_format, plans[fname][2])
+            print(output, end='')
+            timings[fname] = seconds
+            finished(fname, plans[fname][1])
+
+    print("Per-table timing (slowest first):")
+    for fname, seconds in sorted(timings.items(), key=lambda item: item[1], reverse=True):
+        print(f"  {get_table_name(fname)}: {seconds:.2f}s")
+    print('Date shifting complete. Output written to', OUTPUT_DIR)
 
-print('Date shifting complete. Output written to', OUTPUT_DIR) 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import pytest
+
+from server import add_default_limit
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("SELECT * FROM person", "SELECT * FROM person LIMIT 11"),
+    ("SELECT * FROM person;", "SELECT * FROM person LIMIT 11"),
+    ("SELECT * FROM person -- all of them", "SELECT * FROM person LIMIT 11"),
+    ("SELECT 1", "SELECT 1 LIMIT 11"),
+    # Subqueries and CTEs keep their own limits
+    ("SELECT * FROM (SELECT * FROM person LIMIT 5)", "SELECT * FROM (SELECT * FROM person LIMIT 5) LIMIT 11"),
+    ("WITH p AS (SELECT * FROM person LIMIT 5) SELECT * FROM p",
+     "WITH p AS (SELECT * FROM person LIMIT 5) SELECT * FROM p LIMIT 11"),
+    ("SELECT 'no LIMIT 5 here' FROM person", "SELECT 'no LIMIT 5 here' FROM person LIMIT 11"),
+    # LIMIT BY limits rows per group only
+    ("SELECT * FROM visit_occurrence LIMIT 2 BY person_id",
+     "SELECT * FROM visit_occurrence LIMIT 2 BY person_id LIMIT 11"),
+    # Before trailing SETTINGS, FORMAT and INTO OUTFILE
+    ("SELECT * FROM person SETTINGS max_threads = 1", "SELECT * FROM person LIMIT 11 SETTINGS max_threads = 1"),
+    ("SELECT * FROM person FORMAT JSON", "SELECT * FROM person LIMIT 11 FORMAT JSON"),
+    ("SELECT * FROM person WHERE x = 'a' INTO OUTFILE 'p.csv'",
+     "SELECT * FROM person WHERE x = 'a' LIMIT 11 INTO OUTFILE 'p.csv'"),
+    # Set operations are wrapped, the LIMIT of their last SELECT only applies to it
+    ("SELECT 1 UNION ALL SELECT 2", "SELECT * FROM (SELECT 1 UNION ALL SELECT 2) LIMIT 11"),
+    ("SELECT a FROM t UNION ALL SELECT a FROM u LIMIT 5",
+     "SELECT * FROM (SELECT a FROM t UNION ALL SELECT a FROM u LIMIT 5) LIMIT 11"),
+    ("SELECT a FROM t EXCEPT SELECT a FROM u FORMAT JSON",
+     "SELECT * FROM (SELECT a FROM t EXCEPT SELECT a FROM u) LIMIT 11 FORMAT JSON"),
+    # Keywords used as identifiers
+    ("SELECT format FROM t", "SELECT format FROM t LIMIT 11"),
+    ("SELECT limit FROM t", "SELECT limit FROM t LIMIT 11"),
+    ("SELECT settings, into FROM t", "SELECT settings, into FROM t LIMIT 11"),
+    ("SELECT x AS format FROM t WHERE limit > 1 ORDER BY settings",
+     "SELECT x AS format FROM t WHERE limit > 1 ORDER BY settings LIMIT 11"),
+    ("SELECT t.format, format(x, 'y') FROM t", "SELECT t.format, format(x, 'y') FROM t LIMIT 11"),
+    ("SELECT * EXCEPT (a) FROM t", "SELECT * EXCEPT (a) FROM t LIMIT 11"),
+    ("SELECT `limit` FROM t FORMAT JSON", "SELECT `limit` FROM t LIMIT 11 FORMAT JSON"),
+])
+def test_adds_limit(query, expected):
+    assert add_default_limit(query, 11) == expected
+
+
+@pytest.mark.parametrize("query", [
+    "SELECT * FROM person LIMIT 5",
+    "SELECT * FROM person LIMIT 5 OFFSET 10",
+    "SELECT * FROM person ORDER BY person_id DESC LIMIT 5 SETTINGS max_threads = 1",
+    "SELECT * FROM person LIMIT {n:UInt32}",
+    "WITH p AS (SELECT * FROM person) SELECT * FROM p LIMIT 5",
+    "SELECT * FROM visit_occurrence LIMIT 2 BY person_id LIMIT 5",
+    "SELECT * FROM person ORDER BY person_id OFFSET 10 ROWS FETCH FIRST 5 ROWS ONLY",
+    "SELECT limit FROM t LIMIT 5",
+    "SHOW TABLES",
+    "DESCRIBE person",
+])
+def test_keeps_query(query):
+    assert add_default_limit(query, 11) is None
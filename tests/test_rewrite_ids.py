@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+
+from rewrite_ids import IdMapping
+
+
+def test_string_ids_growing_longer_across_chunks():
+    mapping = IdMapping()
+    mapping.extend(pd.Series(['a', 'bb']))
+    mapping.extend(pd.Series(['ccc', 'bbbbbbbb']))
+    mapping.extend(pd.Series(['a' * 40, 'bb']))
+
+    assert mapping.lookup(pd.Series(['a', 'bb', 'ccc', 'bbbbbbbb', 'a' * 40])).tolist() == [1, 2, 3, 4, 5]
+    # A longer ID is not confused with the prefix it shares with a mapped one
+    assert mapping.lookup(pd.Series(['bbb', 'cc'])).isna().all()
+
+
+def test_string_ids_after_saved_and_reloaded_mapping(tmp_path):
+    mapping = IdMapping()
+    mapping.extend(pd.Series(['x1', 'x2']))
+    mapping = mapping.save(str(tmp_path / 'person.person_id'))
+    mapping.extend(pd.Series(['x10000000', 'x2']))
+
+    assert mapping.lookup(pd.Series(['x1', 'x2', 'x10000000'])).tolist() == [1, 2, 3]
+
+
+def test_numeric_ids_followed_by_string_ids():
+    mapping = IdMapping()
+    mapping.extend(pd.Series([10, 9, 100]))
+    mapping.extend(pd.Series(['9', 'A12', '100']))
+
+    assert mapping.lookup(pd.Series(['10', '9', '100', 'A12'])).tolist() == [1, 2, 3, 4]
+    assert mapping.lookup(pd.Series([10, 9, 100])).tolist() == [1, 2, 3]
+    assert np.all(mapping.keys[:-1] <= mapping.keys[1:])
+
+
+def test_ids_in_order_of_first_appearance_across_merges(monkeypatch):
+    monkeypatch.setattr(IdMapping, 'MERGE_MIN_PENDING', 2)
+    mapping = IdMapping()
+    for chunk in ([30, 10], [10, 20, 30], [5], [20, 40, 5, 1]):
+        mapping.extend(pd.Series(chunk))
+
+    assert mapping.lookup(pd.Series([30, 10, 20, 5, 40, 1, 7])).tolist() == [1, 2, 3, 4, 5, 6, pd.NA]
+    assert len(mapping) == 6
@@ -0,0 +1,49 @@
+import asyncio
+
+import anyio
+import pytest
+
+import server
+
+
+class FakeClient:
+    async def close(self):
+        await asyncio.sleep(0)
+
+
+@pytest.fixture
+def fake_pool(monkeypatch):
+    async def connect(self):
+        return FakeClient()
+
+    monkeypatch.setenv("OMOP_BACKEND", "clickhouse")
+    monkeypatch.setenv("OMOP_CONCEPT_INDEX_PRELOAD", "0")
+    monkeypatch.setattr(server.ClickHousePool, "_connect", connect)
+    yield
+    server._app_context = None
+    server._app_sessions = 0
+
+
+async def open_and_cancel_session():
+    """Open a session, then end it by cancellation, as when a client disconnects"""
+    async with anyio.create_task_group() as tasks:
+        opened = anyio.Event()
+
+        async def session():
+            async with server.app_lifespan(server.mcp) as app:
+                assert not app.pool._closed
+                opened.set()
+                await anyio.sleep_forever()
+
+        tasks.start_soon(session)
+        await opened.wait()
+        tasks.cancel_scope.cancel()
+
+
+def test_session_after_last_session_closed(fake_pool):
+    asyncio.run(open_and_cancel_session())
+    assert server._app_context is None
+    assert server._app_sessions == 0
+
+    asyncio.run(open_and_cancel_session())
+    assert server._app_context is None
@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from shift_omop_dates import shift_date, shift_dates
+
+
+def shift_rows(values, shifts, col):
+    """shift_date applied row by row, as before the vectorized version"""
+    return [shift_date(v, s, col) if pd.notnull(v) else v for v, s in zip(values, shifts)]
+
+
+def assert_same(actual, expected):
+    assert len(actual) == len(expected)
+    for a, e in zip(actual, expected):
+        if pd.isnull(e):
+            assert pd.isnull(a)
+        else:
+            assert a == e
+
+
+CASES = [
+    # Leap days, into leap and non-leap years
+    ('condition_start_date', ['2020-02-29', '2020-02-29', '2016-02-29', '2019-02-28'], [-4, -3, -100, 1]),
+    # Capped at the end of 2024
+    ('condition_start_date', ['2020-06-15', '2024-12-31', '1990-01-01'], [5, 0, 40]),
+    ('condition_start_datetime', ['2020-06-15 10:30:00', '2024-12-31 23:59:59', '2023-05-01 08:00:00'], [5, 0, 2]),
+    # Datetimes, also with a time of day in date columns
+    ('visit_start_datetime', ['2010-02-28 23:59:59', '2012-02-29 12:00:00', '2000-01-01'], [-7, -1, -30]),
+    ('visit_start_date', ['2010-02-28 23:59:59', '2012-02-29 12:00:00'], [-7, 1]),
+    # Unparseable and missing values
+    ('drug_exposure_start_date', ['not a date', None, np.nan, '', '2001-13-45', '2001-01-01'], [-3, -3, -3, -3, -3, -3]),
+    # Shifted out of the range of pandas timestamps
+    ('observation_date', ['1700-03-01', '2200-07-04'], [-50, 70]),
+]
+
+
+@pytest.mark.parametrize('col, values, shifts', CASES)
+def test_shift_dates_matches_shift_date(col, values, shifts):
+    values = pd.Series(values, dtype=object)
+    assert_same(shift_dates(values, pd.Series(shifts), col).tolist(), shift_rows(values, shifts, col))
+
+
+def test_shift_dates_of_numeric_column():
+    values = pd.Series([20200101, np.nan, 20200229])
+    shifts = [-2, -2, -1]
+    col = 'death_date'
+    assert_same(shift_dates(values, pd.Series(shifts), col).tolist(), shift_rows(values, shifts, col))